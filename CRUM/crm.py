@@ -3,8 +3,350 @@
 # Changelog
 # 200205 - Separated from CRUM.py #holm10
 
+class CONTEXT:
+
+
+    def __init__(self,crm,Te,ne,Ti,ni,E,Tm,rad):
+        ''' Creates an evaluation context for a plasma state of a CRM
+            __init__(crm,Te,ne,Ti,ni,E,Tm,rad)
+
+            crm     -   CRM object the context belongs to
+            Te      -   Background plasma electron temperature [eV]
+            ne      -   Background plasma electron density [cm**-3]
+            Ti      -   Background plasma ion temperature [eV]
+            ni      -   Background plasma ion density [cm**-3]
+            E       -   Target particle energy [eV]
+            Tm      -   Molecular temperature [eV], E used if False
+            rad     -   Switch for the ionization and recombination radiation
+
+            The reaction rates, the rate matrix, the energy matrices and the MQ solution of the 
+            Greenland reduction of the state are evaluated on first request and kept, so that all
+            matrices of the state share them. The kept arrays are read-only.
+        '''
+        from CRUM.reactions import copy_state
+        self.crm=crm
+        self.state=copy_state((Te,ne,Ti,ni,E,Tm,rad))
+        self.k=None     # Reaction rates
+        self.mat={}     # Assembled matrices and sources, by mode
+        self.X=None     # Solution of MQ*X=[V,GQ]
+
+
+    def rates(self):
+        ''' Returns the rates of all reactions of the flattened state, see CRM.rates '''
+        from numpy import broadcast_arrays
+        if self.k is None:
+            Te,ne,Ti,ni,E=self.state[:5]
+            self.k=self.crm.rates(*[x.ravel() for x in broadcast_arrays(Te,Ti,E,ne)])
+        return self.k
+
+
+    def matrix(self,mode='M',Ton=True):
+        ''' Returns the matrix and external source of the state
+            matrix(*keys)
+
+            Optional parameters
+            mode ('M')  -   'M' for the rate matrix, 'Sgl', 'I' or 'E' for the energy matrices
+            Ton (True)  -   Switch for the temperature-dependent energy terms
+        '''
+        key=(mode,Ton*(mode!='M'))
+        if key not in self.mat:
+            Te,ne,Ti,ni,E,Tm,rad=self.state
+            if mode=='M':
+                ret=self.crm.factorized(Te,ne,Ti,ni,E)
+            else:
+                ret=self.crm.assemble_energy(mode,Te,ne,Ti,ni,E,rad,Tm,Ton,k=self.rates())
+            for x in ret: 
+                x.flags.writeable=False
+            self.mat[key]=ret
+        return self.mat[key]
+
+
+    def reduction(self):
+        ''' Returns the solution X of MQ*X=[V,GQ] of the Greenland reduction of the state '''
+        from numpy import concatenate
+        from numpy.linalg import solve
+        if self.X is None:
+            mat,ext=self.matrix()
+            Np=self.crm.Np
+            self.X=solve(mat[...,Np:,Np:],concatenate([mat[...,Np:,:Np],ext[...,Np:,None]],axis=-1))
+            self.X.flags.writeable=False
+        return self.X
+
+
+
+class PROPAGATOR:
+
+
+    def __init__(self,mat,ext,n0,t,method='eig',points=1001,steady=None,nd=None):
+        ''' Creates the exact solution of the linear system dn/dt=mat*n+ext
+            __init__(mat,ext,n0,t,*keys)
+
+            mat     -   Constant rate matrix, NxN
+            ext     -   Constant external source, N vector
+            n0      -   Initial densities, N vector or NxK block of K initial distributions
+            t       -   Final time of the solution, or array of the times of the solution [s]
+
+            Optional parameters
+            method ('eig')  -   'eig' to propagate using the eigendecomposition of mat, falling back
+                                to 'expm' if the eigenvectors are ill-conditioned. 'expm' to propagate
+                                using the matrix exponential of mat augmented by ext
+            points (1001)   -   Number of equidistant times of the solution if t is the final time
+            steady (None)   -   Tolerance of the steady-state event. If set, the solution is terminated
+                                at the first time where |mat*n+ext|/|n|<steady [1/s]
+            nd (None)       -   Number of trailing (density) entries of n considered by the steady-state 
+                                event. All entries are considered if None
+
+            For mat=T*D*inv(T), the solution is
+                n(t)=T*(exp(D*t)*inv(T)*n0+t*phi(D*t)*inv(T)*ext), phi(z)=(exp(z)-1)/z
+            which equals the steady-state offset form n(t)=nss+exp(mat*t)*(n0-nss), nss=-inv(mat)*ext,
+            but remains valid for singular mat. The solution object mimics the output of solve_ivp:
+            t and y hold the times and densities of the solution, and sol(t) returns the densities
+            at any (array of) time(s). For a block of initial distributions, all K trajectories are
+            propagated with the same factorization and the densities are returned as (N,K,...).
+            If the steady-state event occurs, the solution ends at the time reached, which is also
+            stored with the final state in t_events and y_events.
+        '''
+        from numpy import linspace,ndim,array,zeros,ones,append,vstack
+        from numpy.linalg import eig,solve,cond
+
+        n0=array(n0,dtype=float)
+        self.method=method
+        self.N=len(n0)
+        self.shape=n0.shape[1:] # Shape of the block of initial distributions
+        n0=n0.reshape((self.N,-1))
+        self.mat,self.ext=mat,ext
+        if method=='eig':
+            self.eigs,self.T=eig(mat)
+            if cond(self.T)<1e10:
+                self.c=solve(self.T,n0)     # Initial densities in the eigenbasis
+                self.d=solve(self.T,ext)    # Source in the eigenbasis
+            else:
+                self.method='expm'
+        if self.method=='expm':
+            # Augment the matrix by the source, so that exp(A*t)*[n0,1]=[n(t),1]
+            self.A=zeros((self.N+1,self.N+1))
+            self.A[:self.N,:self.N]=mat
+            self.A[:self.N,self.N]=ext
+            self.n0=vstack((n0,ones((1,n0.shape[1]))))
+
+        self.t=linspace(0,t,points) if ndim(t)==0 else array(t)
+        self.success=True
+        self.status=0
+        self.message='Linear system propagated using {}.'.format(self.method)
+        self.t_events,self.y_events=None,None
+        if steady is not None: # Look for the steady state within the solution
+            tss=self.steady_time(self.t[-1],steady,-(nd or self.N))
+            self.t_events,self.y_events=[zeros((0,))],[zeros((0,self.N)+self.shape)]
+            if tss is not None: # End the solution at the steady state
+                self.t=linspace(0,tss,points) if ndim(t)==0 else append(self.t[self.t<tss],tss)
+                self.t_events,self.y_events=[self.t[-1:]],[self.sol(self.t[-1])[None]]
+                self.status=1
+                self.message='Steady state reached.'
+        self.y=self.sol(self.t)
+
+
+    def steady_time(self,t,tol,i0=0,points=400,iterations=60):
+        ''' Returns the first time before t where |mat*n+ext|/|n|<tol for the entries i0: of n, or None 
+            For blocks of initial distributions, the norms are taken over all K distributions
+        '''
+        from numpy import geomspace,append,argmax,tensordot
+        from numpy.linalg import norm
+        
+        def converged(tt): # Tests the steady-state criterion at the times tt
+            n=self.propagate(tt)
+            r=tensordot(self.mat,n,1)+self.ext[:,None,None]
+            return norm(r[i0:],axis=(0,1))<tol*norm(n[i0:],axis=(0,1))
+
+        # Scan logarithmically spaced times, then bisect the interval containing the first crossing
+        tt=append(0,geomspace(t*1e-12,t,points))
+        ok=converged(tt)
+        if not ok.any(): return None
+        j=argmax(ok)
+        if j==0: return 0.
+        ta,tb=tt[j-1],tt[j]
+        for i in range(iterations):
+            tm=0.5*(ta+tb)
+            if converged([tm])[0]: tb=tm
+            else: ta=tm
+        return tb
+
+
+    def propagate(self,t,integral=False):
+        ''' Returns the densities, or their time-integrals from 0 if integral, at the times t 
+            as a (N,K,len(t)) array 
+        '''
+        from numpy import array,where,expm1,exp,real,atleast_1d,tensordot,moveaxis,zeros,identity,vstack
+        from scipy.linalg import expm
+
+        tt=atleast_1d(array(t,dtype=float))
+        N=self.N
+        if self.method=='eig':
+            z=self.eigs[:,None]*tt
+            lam=where(self.eigs==0,1,self.eigs)[:,None]
+            f=where(self.eigs[:,None]==0,tt,expm1(z)/lam) # t*phi(lambda*t)
+            if not integral:
+                return real(tensordot(self.T,exp(z)[:,None,:]*self.c[:,:,None]+(f*self.d[:,None])[:,None,:],1))
+            # Integrals of exp(lambda*t) and t*phi(lambda*t), using the series for small lambda*t
+            g=where(abs(z)<1e-4,tt**2*(0.5+z/6+z**2/24),(expm1(z)-z)/lam**2)
+            return real(tensordot(self.T,f[:,None,:]*self.c[:,:,None]+(g*self.d[:,None])[:,None,:],1))
+        elif not integral:
+            return moveaxis((expm(self.A*tt[:,None,None])@self.n0)[:,:N],0,-1)
+        else: # Augment by the integrated densities, d/dt int(n)=n
+            B=zeros((2*N+1,2*N+1))
+            B[:N+1,:N+1]=self.A
+            B[N+1:,:N]=identity(N)
+            return moveaxis((expm(B*tt[:,None,None])@vstack((self.n0,0*self.n0[:N])))[:,N+1:],0,-1)
+
+
+    def sol(self,t):
+        ''' Returns the densities at the time(s) t, (N,) for a scalar and (N,len(t)) for an array 
+            Blocks of initial distributions add the K axis after N, (N,K) and (N,K,len(t))
+        '''
+        from numpy import ndim
+
+        ret=self.propagate(t).reshape((self.N,)+self.shape+(-1,))
+        return ret[...,0] if ndim(t)==0 else ret
+
+
+    def integral(self,t):
+        ''' Returns the densities integrated in time from 0 to t, shaped as sol(t) [s*cm**-3] '''
+        from numpy import ndim
+
+        ret=self.propagate(t,True).reshape((self.N,)+self.shape+(-1,))
+        return ret[...,0] if ndim(t)==0 else ret
+
+
+
+class DEPOSITION:
+
+
+    def __init__(self,density,Q,q,E0=0):
+        ''' Creates the solution of the energy channels accumulated along a density solution
+            __init__(density,Q,q,*keys)
+
+            density -   PROPAGATOR or solve_ivp bunch object (with dense output) of the densities
+            Q       -   Energy rate matrix of the channels, rates per density, C x N
+            q       -   Constant energy rate of the channels, C vector
+
+            Optional parameters
+            E0 (0)  -   Initial energies of the channels
+
+            The channels evolve as dE/dt=Q*n+q, and are obtained from the time-integrated densities 
+                E(t)=E0+Q*int(n,0,t)+q*t
+            rather than by solving for them alongside the densities. The integrals are analytic for a 
+            PROPAGATOR, and obtained by Gauss-Legendre quadrature of the dense output, step by step, 
+            for a solve_ivp solution. The object mimics the output of solve_ivp: sol(t) returns the 
+            channels stacked on top of the densities.
+        '''
+        from numpy import zeros,cumsum,concatenate
+        from numpy.polynomial.legendre import leggauss
+
+        self.density,self.Q,self.q,self.E0=density,Q,q,E0
+        if not hasattr(density,'integral'): # Integrate each solver step of the dense output 
+            self.x,self.w=leggauss(8) # Exact for the polynomial interpolants of the solvers
+            ts=density.sol.ts
+            steps=self.quadrature(ts[:-1],ts[1:])
+            self.cum=concatenate([zeros((len(steps),1)),cumsum(steps,axis=1)],axis=1)
+        for key in ['success','status','message','t_events']:
+            setattr(self,key,getattr(density,key))
+        self.t=density.t
+        self.y=self.sol(self.t)
+        self.y_events=None
+        if self.t_events is not None:
+            self.y_events=[self.sol(x).T for x in self.t_events]
+
+
+    def quadrature(self,a,b):
+        ''' Returns the integrals of the dense output densities between the times a and b '''
+        nodes=(a+b)/2+(b-a)/2*self.x[:,None]
+        vals=self.density.sol(nodes.ravel()).reshape((-1,)+nodes.shape)
+        return (vals*self.w[:,None]).sum(axis=1)*(b-a)/2
+
+
+    def integral(self,t):
+        ''' Returns the densities integrated in time from 0 to t [s*cm**-3] '''
+        from numpy import atleast_1d,array,searchsorted,clip,ndim
+
+        if hasattr(self.density,'integral'):
+            return self.density.integral(t)
+        tt=atleast_1d(array(t,dtype=float))
+        ts=self.density.sol.ts
+        j=clip(searchsorted(ts,tt,'right')-1,0,len(ts)-2)
+        ret=self.cum[:,j]+self.quadrature(ts[j],tt)
+        return ret[:,0] if ndim(t)==0 else ret
+
+
+    def sol(self,t):
+        ''' Returns the energy channels stacked on top of the densities at the time(s) t '''
+        from numpy import concatenate,multiply
+
+        E=self.Q@self.integral(t)+multiply.outer(self.q,t)
+        E=(E.T+self.E0).T
+        return concatenate([E,self.density.sol(t)])
+
+
+
+class LOGGER:
+
+
+    def __init__(self,path='logs'):
+        ''' Creates a background writer of binary (npz) logs
+            __init__(*keys)
+
+            Optional parameters
+            path ('logs')   -   Directory of the logs
+
+            Logs are queued by write and saved by a daemon thread, so the caller never waits for the 
+            file system. The thread is started on the first write, and flush waits for the queue.
+        '''
+        self.path=path
+        self.queue=None
+
+
+    def run(self):
+        ''' Saves the queued logs until the program exits '''
+        from numpy import savez
+
+        while True:
+            fname,arrays=self.queue.get()
+            try:
+                savez(fname,**arrays)
+            except Exception as e:
+                print('WARNING! Could not write log {}: {}'.format(fname,e))
+            self.queue.task_done()
+
+
+    def write(self,name,**arrays):
+        ''' Queues the arrays to be saved in path/name.npz '''
+        from queue import Queue
+        from threading import Thread
+        from atexit import register
+
+        if self.queue is None: # Start the writer
+            self.queue=Queue()
+            Thread(target=self.run,daemon=True).start()
+            register(self.flush) # Do not lose queued logs at exit
+        self.queue.put(('{}/{}.npz'.format(self.path,name),arrays))
+
+
+    def flush(self):
+        ''' Waits until all queued logs are saved '''
+        if self.queue is not None:
+            self.queue.join()
+
+
+    def read(self,name):
+        ''' Returns the arrays saved in path/name.npz as a dictionary '''
+        from numpy import load
+
+        self.flush()
+        with load('{}/{}.npz'.format(self.path,name)) as f:
+            return {key:f[key] for key in f.files}
+
+
+
 class CRM:
-    def __init__(self,species,reactions,settings,path='.',recrad=None,ionizrad=None):
+    def __init__(self,species,reactions,settings,path='.',recrad=None,ionizrad=None,io=True):
         ''' Creates a CRM class, at the heart of CRUM
             __init__(species,reactions,settings)
 
@@ -19,9 +361,14 @@ class CRM:
 
             Optional parameters
             path ('.')  -   Path to CRUm run directory
+            io (True)   -   Switch for writing logs. If False, no files are written unless explicitly
+                            requested (e.g. by DIAGNOSTIC or render_matrix), and write requests of the 
+                            matrix functions are ignored
         '''
         from os import mkdir,getcwd
         from datetime import datetime
+        from collections import OrderedDict
+        from CRUM.reactions import REACTION_TABLE
 
         # Store class objects
         self.species=species
@@ -32,6 +379,20 @@ class CRM:
         self.path=path
         self.ionizrad=ionizrad
         self.recrad=recrad
+        # Collect the rate data into one table, evaluating all EIRENE, ADAS and UEDGE rates together
+        self.table=REACTION_TABLE(self.reactions+[r for r in [ionizrad,recrad] if r is not None])
+        # Compile the reaction network into sparse index arrays
+        self.compile_network()
+        # Evaluation contexts of the latest plasma states, least recently used first
+        self.contexts=OrderedDict()
+        self.maxcontexts=32
+        # Temperature-dependent components of the rate matrix of the latest temperatures
+        self.tcomponents=OrderedDict()
+        # Background writer of the matrix logs
+        self.io=io
+        self.logger=LOGGER('logs')
+        if not io: # No I/O: skip the setup log and the diagnostic until requested
+            return
 
         # Ensure that there is a logs directory under the run path
         try:
@@ -58,82 +419,422 @@ class CRM:
         # Do the same for a Diagnostic rate matrix displaying reaction correlations
         self.DIAGNOSTIC()
 
+    def tabulate(self,rtol=1e-3,T=[0.1,1e4],E=[0.1,1e3]):
+        ''' Pretabulates the rate coefficients of the CRM reactions
+            tabulate(*keys)
+
+            Optional parameters
+            rtol (1e-3)         -   Maximum relative error of the tabulated rates
+            T ([0.1,1e4])       -   Temperature limits of the tables [eV]
+            E ([0.1,1e3])       -   Target particle energy limits of the tables [eV]
+
+            The EIRENE, ADAS and SIGMA rates are subsequently interpolated from adaptive log-log
+            tables, shared by all matrices and energy terms of the CRM. See REACTION_TABLE.tabulate.
+        '''
+        self.table.tabulate(rtol,T,E)
+        # Discard contexts and components evaluated with the previous rates
+        self.contexts.clear()
+        self.tcomponents.clear()
+
+
+    def context(self,Te,ne,Ti=None,ni=None,E=0.1,Tm=False,rad=True):
+        ''' Returns the evaluation context of a plasma state
+            context(Te,ne,*keys)
+
+            Te          -   Background plasma electron temperature [eV]
+            ne          -   Background plasma electron density [cm**-3]
+
+            Optional parameters
+            Ti (None)   -   Background plasma ion temperature [eV]. Ti=Te if Ti is None
+            ni (None)   -   Background plasma ion density [cm**-3]. ni=ne if ni is None
+            E (0.1)     -   Target particle energy [eV]
+            Tm (False)  -   Molecular temperature [eV], E used if False
+            rad (True)  -   Switch for the ionization and recombination radiation
+
+            The contexts of the latest maxcontexts states are kept, evicting the least recently
+            used. The plasma parameters can be arrays. See CONTEXT.
+        '''
+        from CRUM.reactions import state_key
+
+        if Ti is None: Ti=Te # Check for Ti, set if necessary
+        if ni is None: ni=ne # Check for ni, set if necessary
+        state=(Te,ne,Ti,ni,E,Tm,rad)
+        key=state_key(state)
+        if key in self.contexts:
+            self.contexts.move_to_end(key)
+        else:
+            self.contexts[key]=CONTEXT(self,*state)
+            while len(self.contexts)>self.maxcontexts:
+                self.contexts.popitem(last=False)
+        return self.contexts[key]
+
+
+    def find_context(self,mat):
+        ''' Returns the kept context whose rate matrix is mat, or None '''
+        for ctx in self.contexts.values():
+            if ('M',0) in ctx.mat and ctx.mat[('M',0)][0] is mat:
+                return ctx
+        return None
+
+
     def get_reaction(self,name):
         for r in self.reactions:
             if name==r.name:
                 return r        
 
 
-    def getS(self,r,Te,Ti,Tm,E,ne,rad=True,Ton=True):
-        ''' To output:
-            S_el    Sext_el
-            S_eV    Sext_eV
-            S_ega   Sext_ega
-            S_egm   Sext_egm
-            S_pe    Sext_pe
-            S_pV    Sext_pV
-            S_pga   Sext_pga
-            S_pgm   Sext_pgm
-        '''
-        from numpy import zeros,array
-        #print('==={}==='.format(r.name))
+    def compile_network(self):
+        ''' Compiles the reaction network into COO index arrays for assembling the rate matrices
+            compile_network()
 
+            Each reaction contributes the following entries, stored with the reaction index
+            and the density multiplier of the entry:
+            Depletion       -   (k,k) for each reactant k in species, multiplied by -r_mult
+            Internal source -   (i,j) for each fragment i in species, multiplied by f_mult, where j
+                                is the last reactant in species
+            External source -   i for each fragment i in species, multiplied by f_mult, if no 
+                                reactant is in species
+            The background-density flags of the reactions mark electron and proton reactants.
+        '''
+        from numpy import array
+
+        rows,cols,mult,reac=[],[],[],[]     # Matrix entries
+        erows,emult,ereac=[],[],[]          # External source entries
+        src=[]                              # Positions of the internal source entries
+        for k in range(len(self.reactions)):
+            r=self.reactions[k]
+            j=None # Set flag to identify external sources
+            for rea in range(len(r.reactants)):
+                if r.reactants[rea] not in self.species:
+                    continue
+                j=self.species.index(r.reactants[rea])
+                ''' DEPLETION '''
+                rows.append(j)
+                cols.append(j)
+                mult.append(-r.r_mult[rea])
+                reac.append(k)
+            for frag in range(len(r.fragments)):
+                # Do nothing if background fragment
+                if r.fragments[frag] not in self.species:
+                    continue
+                i=self.species.index(r.fragments[frag])
+                if j is None:
+                    ''' EXTERNAL SOURCE '''
+                    erows.append(i)
+                    emult.append(r.f_mult[frag])
+                    ereac.append(k)
+                else:
+                    ''' INTERNAL SOURCE '''
+                    src.append(len(rows))
+                    rows.append(i)
+                    cols.append(j)
+                    mult.append(r.f_mult[frag])
+                    reac.append(k)
+
+        self.net_rows,self.net_cols=array(rows,dtype=int),array(cols,dtype=int)
+        self.net_mult,self.net_reac=array(mult,dtype=float),array(reac,dtype=int)
+        self.net_erows,self.net_emult,self.net_ereac=array(erows,dtype=int),array(emult,dtype=float),array(ereac,dtype=int)
+        self.net_src=array(src,dtype=int)
+        # Background-density flags and the reactions contributing to the matrices
+        self.net_e=array([('e' in r.reactants) for r in self.reactions],dtype=float)
+        self.net_p=array([('p' in r.reactants) for r in self.reactions],dtype=float)
+        self.net_active=sorted(set(reac+ereac))
+        # Density-dependent UEDGE rates are separated from the temperature-dependent rates
+        self.net_ue=[k for k in self.net_active if self.reactions[k].type=='UE']
+        self.net_T=[k for k in self.net_active if self.reactions[k].type!='UE']
+
+        self.compile_energy()
+
+
+    def compile_energy(self):
+        ''' Compiles the energy expressions of the reactions into the Greenland energy channels
+            compile_energy()
+
+            The channels are el, ia, V, ga and gm. The energy of each reaction in each channel is
+            stored as coefficients on [1,Te,Ti,Tm], where Tm is replaced by E if no Tm is given,
+            together with the coefficients on the ionization and recombination radiation 
+            (erl1 and erl2), which are evaluated as external sources. The energy entries are the 
+            source entries of the compiled network, see compile_network.
+        '''
+        from numpy import zeros
 
-        Sl=[r.S_r,r.S_V,r.S_g]
-        ret=zeros((8,2))
-        offset=0
-        if 'p' in r.reactants:  # We have a proton reaction: count p->e, p->V, and p->g
-            if 'e' not in r.reactants: # Fx for recombination
+        basis=[[0,0,0],[1,0,0],[0,1,0],[0,0,1]] # Constant, Te, Ti and Tm/E
+        self.en_coeff=zeros((len(self.reactions),5,4))
+        self.en_rad=zeros((len(self.reactions),5,2))
+        for k in range(len(self.reactions)):
+            r=self.reactions[k]
+            Sl=[r.S_r,r.S_V,r.S_g]
+            if ('p' in r.reactants) and ('e' not in r.reactants): # Fx for recombination
                 Sl[0]=r.S_e
-                offset=4
-        
+            S=zeros((3,4))
+            rad=zeros((3,2))
+            for i in range(3):
+                val=Sl[i]
+                if callable(val):
+                    # The entry is a compiled expression: get the coefficients, assuming linearity in T
+                    S[i]=[val(*b) for b in basis]
+                    S[i,1:]-=S[i,0]
+                    # Set external radiation source
+                    if val.erl:
+                        rad[i,val.erl-1]=val.rad
+                else:
+                    S[i,0]=val
+            ''' Check whether radiation is due to a molecule or atom '''
+            g=3+(r.database not in ['ADAS']) # TODO: catch-all for atomic radiation needed!
+            for C,X in [[self.en_coeff[k],S],[self.en_rad[k],rad]]:
+                C[0]=X[0]           # el
+                C[1]=-X.sum(axis=0) # ia
+                C[2]=X[1]           # V
+                C[g]=X[2]           # ga/gm
 
 
-        for i in range(3):
-            ext=0
-            g=0
-            val=Sl[i]
-            # The entry is in string form: turn into number
-            if isinstance(val,str):  
-                temp=val.replace('erl1','0').replace('erl2','0') # Remove radiation contribution - evaluated as external source
-                temp=temp.replace('Te',str(Te*Ton))
-                temp=temp.replace('Ti',str(Ti*Ton))
-                temp=temp.replace('Ta',str(Ti*Ton))         
-                temp=temp.replace('Tm',str(Ton*(Tm is not False)*Tm+Ton*(Tm is False)*E))
+    def densities(self,ne,ni):
+        ''' Returns the background densities of all reactions
+            densities(ne,ni)
+
+            ne      -   Background plasma electron density [cm**-3]
+            ni      -   Background plasma ion density [cm**-3]
 
-                # Set external radiation source
-                if 'erl1' in val:
-                    ext=((-1)**('-erl' in val))*self.ionizrad.rate(Te,Ti,E,ne)*rad
+            Returns
+            bg,bgm
 
-                elif 'erl2' in val:
-                    ext=((-1)**('-erl' in val))*self.recrad.rate(Te,Ti,E,ne)*rad
+            bg      -   Background density of the matrix entries
+            bgm     -   Background density of the external sources
+        '''
+        from numpy import maximum,ndim
+        # Broadcast the flags over the shape of the densities
+        e=self.net_e.reshape((-1,)+(1,)*max(ndim(ne),ndim(ni)))
+        p=self.net_p.reshape(e.shape)
+        # TODO: what if three-particle reaction?
+        bg=maximum(e*ne+p*ni,1)     # Assure that auto-processes are considered
+        bgm=(e*ne)*(p*ni)           # Density for external sources
+        return bg,bgm
 
-                #print(self.ionizrad.rate(Te,Ti,E,ne),self.recrad.rate(Te,Ti,E,ne))
 
-                if len(r.reactants)==1: # Radiative decay
-                    S=eval(temp)
-                else: # Two-particle process 
-                    S=eval(temp)
+    def rates(self,Te,Ti,E,ne,active=None):
+        ''' Returns an array of the rates of all reactions, evaluated once per reaction
+            rates(Te,Ti,E,ne,*keys)
 
-            else:
-                S=val  
+            Te          -   Electron temperature [eV]
+            Ti          -   Ion temperature [eV]
+            E           -   Target particle energy [eV]
+            ne          -   Electron density [cm**-3]
 
-            ''' Check whether radiation is due to a molecule or atom '''
-            if i==2: # Only check when trating radiation
-                if r.database in ['ADAS']: # TODO: catch-all for atomic radiation needed!
-                    g=0
-                else: # Not atomic line rad
-                    g=1
-                
-
-             
-            ret[i+offset+g,:]=array([S,ext])
-            
+            Optional parameters
+            active (None)   -   Indices of the reactions to evaluate, net_active if None
 
+            The plasma parameters can be arrays, in which case an array (n_reactions,)+shape is 
+            returned, where shape is the broadcast shape of the parameters. Only reactions 
+            contributing to the rate matrices are evaluated, the others are zero
+        '''
+        from numpy import zeros,broadcast
+        if active is None: active=self.net_active
+        ret=zeros((len(self.reactions),)+broadcast(Te,Ti,E,ne).shape)
+        for k in active:
+            ret[k]=self.reactions[k].rate(Te,Ti,E,ne)
         return ret
-        
 
-        
+
+    def scatter(self,w,wext,shape):
+        ''' Scatters weighted reaction rates onto the entries of the compiled network
+            scatter(w,wext,shape)
+
+            w       -   Weights of the reactions in the matrix, (n_reactions,K)
+            wext    -   Weights of the reactions in the external source, (n_reactions,K)
+            shape   -   Shape of the batch, of size K
+
+            Returns
+            matrix,ext_source of shapes shape+(N,N) and shape+(N,)
+        '''
+        from numpy import bincount,arange
+
+        N=len(self.species)
+        K=w.shape[1]
+        # Scatter the entries of all points in the batch at once
+        idx=(self.net_rows*N+self.net_cols)[:,None]+N*N*arange(K)
+        ret=bincount(   idx.ravel(),weights=(self.net_mult[:,None]*w[self.net_reac]).ravel(),
+                        minlength=K*N*N).reshape(shape+(N,N))
+        idx=self.net_erows[:,None]+N*arange(K)
+        ext=bincount(   idx.ravel(),weights=(self.net_emult[:,None]*wext[self.net_ereac]).ravel(),
+                        minlength=K*N).reshape(shape+(N,))
+        return ret,ext
+
+
+    def assemble(self,mode,Te,ne,Ti,ni,E,k=None,active=None):
+        ''' Assembles the rate (coefficient) matrix from the compiled reaction network
+            assemble(mode,Te,ne,Ti,ni,E,*keys)
+
+            mode    -   'R' for the rate coefficient matrix, 'M' for the rate matrix
+            Te      -   Background plasma electron temperature [eV]
+            ne      -   Background plasma electron density [cm**-3]
+            Ti      -   Background plasma ion temperature [eV]
+            ni      -   Background plasma ion density [cm**-3]
+            E       -   Target particle energy [eV]
+
+            Optional parameters
+            k (None)        -   Precomputed rates of the flattened batch, (n_reactions,K), see rates
+            active (None)   -   Indices of the reactions to include, all if None
+
+            The plasma parameters can be arrays, which are broadcast against each other. The rates
+            are evaluated and the matrices assembled for the whole batch at once.
+
+            Returns
+            matrix,ext_source
+
+            matrix      -   Matrix of shape shape+(N,N), where shape is the broadcast shape of the
+                            plasma parameters
+            ext_source  -   External source of shape shape+(N,)
+        '''
+        from numpy import ones,broadcast_arrays
+
+        Te,ne,Ti,ni,E=broadcast_arrays(Te,ne,Ti,ni,E)
+        shape=Te.shape
+        Te,ne,Ti,ni,E=[x.ravel() for x in [Te,ne,Ti,ni,E]] # Flatten the batch
+
+        if k is None: k=self.rates(Te,Ti,E,ne,active)
+        if mode=='M':
+            bg,bgm=self.densities(ne,ni)
+        else:
+            bg=bgm=ones((len(self.reactions),Te.size))
+        return self.scatter(k*bg,k*bgm,shape)
+
+
+    def components(self,Te,Ti,E):
+        ''' Returns the temperature-dependent components of the rate matrix
+            components(Te,Ti,E)
+
+            Te      -   Background plasma electron temperature [eV]
+            Ti      -   Background plasma ion temperature [eV]
+            E       -   Target particle energy [eV]
+
+            The rate matrix is decomposed according to the background species of the reactions as
+                M=max(ne,1)*Re+max(ni,1)*Rp+A+max(ne+ni,1)*Rep, ext=ne*ni*Gep
+            excluding the density-dependent UEDGE rates. The components of the latest maxcontexts 
+            temperatures are kept, evicting the least recently used.
+
+            Returns
+            Re,Rp,A,Rep,Gep of shapes shape+(N,N) and shape+(N,) for Gep, where shape is the 
+            broadcast shape of Te, Ti and E
+        '''
+        from numpy import broadcast_arrays
+        from CRUM.reactions import state_key
+
+        key=state_key((Te,Ti,E))
+        if key in self.tcomponents:
+            self.tcomponents.move_to_end(key)
+            return self.tcomponents[key]
+
+        Te,Ti,E=broadcast_arrays(Te,Ti,E)
+        shape=Te.shape
+        Te,Ti,E=[x.ravel() for x in [Te,Ti,E]] # Flatten the batch
+        k=self.rates(Te,Ti,E,None,self.net_T)
+        ret=[]
+        for e,p in [[1,0],[0,1],[0,0],[1,1]]:
+            w=k*((self.net_e==e)*(self.net_p==p))[:,None]
+            mat,ext=self.scatter(w,w,shape)
+            ret.append(mat)
+        ret.append(ext) # Only reactions with both electrons and protons have external sources
+        for x in ret:
+            x.flags.writeable=False
+        self.tcomponents[key]=ret
+        while len(self.tcomponents)>self.maxcontexts:
+            self.tcomponents.popitem(last=False)
+        return ret
+
+
+    def factorized(self,Te,ne,Ti,ni,E):
+        ''' Returns the rate matrix from its temperature-dependent components
+            factorized(Te,ne,Ti,ni,E)
+
+            Te      -   Background plasma electron temperature [eV]
+            ne      -   Background plasma electron density [cm**-3]
+            Ti      -   Background plasma ion temperature [eV]
+            ni      -   Background plasma ion density [cm**-3]
+            E       -   Target particle energy [eV]
+
+            The components are kept per temperature, see components, so that density scans only
+            require matrix additions. The UEDGE rates are added separately.
+
+            Returns
+            matrix,ext_source, as assemble
+        '''
+        from numpy import maximum,asarray
+
+        Re,Rp,A,Rep,Gep=self.components(Te,Ti,E)
+        ne,ni=asarray(ne,dtype=float),asarray(ni,dtype=float)
+        de,dp=ne[...,None,None],ni[...,None,None]
+        mat=maximum(de,1)*Re+maximum(dp,1)*Rp+A+maximum(de+dp,1)*Rep
+        ext=(ne*ni)[...,None]*Gep
+        if len(self.net_ue)>0: # Density-dependent rates
+            mue,eue=self.assemble('M',Te,ne,Ti,ni,E,active=self.net_ue)
+            mat,ext=mat+mue,ext+eue
+        return mat,ext
+
+
+    def assemble_energy(self,mode,Te,ne,Ti,ni,E,rad=True,Tm=False,Ton=True,k=None):
+        ''' Assembles the energy matrices from the compiled energy channels
+            assemble_energy(mode,Te,ne,Ti,ni,E,*keys)
+
+            mode    -   'Sgl' for the energy matrices of the five Greenland channels,
+                        'I' for the atomic/molecular radiation intensity matrices,
+                        'E' for the atomic/molecular radiation energy matrices
+            Te      -   Background plasma electron temperature [eV]
+            ne      -   Background plasma electron density [cm**-3]
+            Ti      -   Background plasma ion temperature [eV]
+            ni      -   Background plasma ion density [cm**-3]
+            E       -   Target particle energy [eV]
+
+            Optional parameters
+            rad (True)  -   Switch for the ionization and recombination radiation
+            Tm (False)  -   Molecular temperature [eV]. Tm=E used if False
+            Ton (True)  -   Switch for the temperature-dependent energy terms
+            k (None)    -   Precomputed rates of the flattened batch, (n_reactions,K), see rates
+
+            The plasma parameters can be arrays, which are broadcast against each other, as in assemble.
+
+            Returns
+            matrix,ext_source
+
+            matrix      -   Matrix of shape shape+(N,N,C), where shape is the broadcast shape of the
+                            plasma parameters and C the number of channels
+            ext_source  -   External source of shape shape+(N,C)
+        '''
+        from numpy import bincount,array,zeros,ones,arange,einsum,broadcast_arrays
+
+        N=len(self.species)
+        if Tm is False: Tm=E # Use the target particle energy unless a molecular temperature is given
+        Te,ne,Ti,ni,E,Tm=broadcast_arrays(Te,ne,Ti,ni,E,Tm)
+        shape=Te.shape
+        Te,ne,Ti,ni,E,Tm=[x.ravel() for x in [Te,ne,Ti,ni,E,Tm]] # Flatten the batch
+        K=Te.size
+
+        if k is None: k=self.rates(Te,Ti,E,ne)
+        bg,bgm=self.densities(ne,ni)
+        # Energy of each reaction in each channel, (n_reactions,K,5)
+        S=einsum('rcb,bk->rkc',self.en_coeff,array([ones(K),Te*Ton,Ti*Ton,Tm*Ton]))
+        ext=zeros(S.shape)
+        for i,r in [[0,self.ionizrad],[1,self.recrad]]:
+            if self.en_rad[:,:,i].any():
+                ext+=self.en_rad[:,None,:,i]*(r.rate(Te,Ti,E,ne)*rad)[:,None]
+
+        src,esrc=self.net_reac[self.net_src],self.net_ereac
+        if mode=='Sgl':
+            w=(k*bg)[src,:,None]*S[src]+ext[src]
+            we=(k*bgm)[esrc,:,None]*S[esrc]+ext[esrc]
+        elif mode=='I':
+            w=(k*bg)[src,:,None]*(abs(S[src,:,3:])>0)
+            we=(k*bgm)[esrc,:,None]*S[esrc,:,3:]
+        elif mode=='E':
+            w=S[src,:,3:]
+            we=S[esrc,:,3:]
+
+        # Scatter the entries of all points and channels at once
+        C=w.shape[-1]
+        idx=((self.net_rows[self.net_src]*N+self.net_cols[self.net_src])[:,None]+N*N*arange(K))[...,None]*C+arange(C)
+        ret=bincount(idx.ravel(),weights=w.ravel(),minlength=K*N*N*C).reshape(shape+(N,N,C))
+        idx=(self.net_erows[:,None]+N*arange(K))[...,None]*C+arange(C)
+        ext_source=bincount(idx.ravel(),weights=we.ravel(),minlength=K*N*C).reshape(shape+(N,C))
+        return ret,ext_source
 
 
     def populate(self,mode,Te,ne,Ti=None,ni=None,E=0,rad=True,Sind=None,Tm=False,Ton=True,Iind=0):
@@ -143,6 +844,10 @@ class CRM:
                             'diagnostic'    -   Creates a 2D list of reactions handles
                             'R'             -   Creates a matrix of rate coefficients (cm**3/s)
                             'M'             -   Creates a matrix of rates (s**-1)
+                            'Sgl'           -   Creates the energy matrices of the Greenland channels
+                            'I','E'         -   Creates the atomic/molecular radiation matrices
+                            The R and M matrices are assembled from the compiled network, see assemble,
+                            and the energy matrices from the compiled energy channels, see assemble_energy
             Te      -   Background plasma electron temperature [eV]
             ne      -   Background plasma electron density [cm**-3]
 
@@ -162,156 +867,45 @@ class CRM:
                             rate matrix
             
         '''
-        from numpy import zeros,array,sum,transpose
-        
-        if mode=='diagnostic':
-            # Setup a 2D diagnostic list for the matrix and a list for the external source
-            ext_source=[]
-            ret=[]
-            for i in range(len(self.species)):
-                ext_source.append([])
-                ret.append([])
-                for j in range(len(self.species)):
-                    ret[i].append([])
-        elif mode=='Sgl':
-            ret=zeros((len(self.species),len(self.species),5))
-            ext_source=zeros((len(self.species),5))
-        elif mode in ['E','I']:
-            ret=zeros((len(self.species),len(self.species),2))
-            ext_source=zeros((len(self.species),2))
-        else:
-            # Setup a matrix and vector
-            ret=zeros((len(self.species),len(self.species)))
-            ext_source=zeros((len(self.species),))
- 
-        for i in range(len(self.species)):
-            ''' Walk through each row (species)'''
+        if mode in ['R','M']: # Assembled from the compiled reaction network
+            return self.assemble(mode,Te,ne,Ti,ni,E)
+        elif mode in ['Sgl','I','E']: # Assembled from the compiled energy channels
+            return self.assemble_energy(mode,Te,ne,Ti,ni,E,rad,Tm,Ton)
 
-            for r in self.reactions:
-                ''' Sort the species of each reaction into the appropriate column '''
+        # Setup a 2D diagnostic list for the matrix and a list for the external source
+        ext_source=[[] for i in range(len(self.species))]
+        ret=[[[] for j in range(len(self.species))] for i in range(len(self.species))]
 
-        
-                ''' Get the energy loss term '''
-                # Create array: first index Sel,SeV,Seg,Spe,SpV,Spg, second index S,ext
-
-                if mode=='Sgl':
-                    S=self.getS(r,Te,Ti,Tm,E,ne,rad,Ton)
-                    Sgl=    array(  [   [S[0]+S[4]],
-                                        [-sum(S,axis=0)],
-                                        [S[1]+S[5]],
-                                        [S[2]+S[6]],
-                                        [S[3]+S[7]] ]   )[:,0,:]
-            
-                elif mode in ['I','E']:
-                    Iv=self.getS(r,Te,Ti,Tm,E,ne,rad,Ton)
-                    I=      array( [    [Iv[2]+Iv[6]],
-                                        [Iv[3]+Iv[7]] ]   )[:,0,:]
- 
+        for r in self.reactions:
+            ''' Sort the species of each reaction into the appropriate elements '''
+            bg=('e' in r.reactants)*ne+('p' in r.reactants)*ni # Specify density for reactions
+            j=None # Set flag to identify external sources
+
+            for rea in range(len(r.reactants)):
+                # Skip background reactants
+                if r.reactants[rea] not in self.species:
+                    continue
+                j=self.species.index(r.reactants[rea])  # Column of the reactant
+                ''' DEPLETION '''
+                ret[j][j].append('-'+str(r.r_mult[rea])+'*'+r.database+'_'+r.name+bg)
+
+            for frag in range(len(r.fragments)):    # Loop through the reaction fragments
+                # Do nothing if background fragment
+                if r.fragments[frag] not in self.species: 
+                    continue
+                i=self.species.index(r.fragments[frag])
+                if j is None: # External flag triggered, store to external source
+                    ''' EXTERNAL SOURCE '''
+                    ext_source[i].append('+'+str(r.f_mult[frag])+'*'+r.database+'_'+r.name+bg)
+                else: # Store to the column of the last reactant
+                    ''' INTERNAL SOURCE '''
+                    ret[i][j].append('+'+str(r.f_mult[frag])+'*'+r.database+'_'+r.name+bg)
 
-                
-                # TODO: what if three-particle reaction?
-                bg=('e' in r.reactants)*ne+('p' in r.reactants)*ni # Specify density for reactions
-                if mode!='diagnostic':
-                    bgm=(('e' in r.reactants)*ne)*(('p' in r.reactants)*ni) # Specify density for external source
-                    bg=max(bg,1)    # Assure that auto-processes are considered
-                j=None # Set flag to identify external sources
-
-                # Loop through each reaction defined in the CRM
-                for rea in range(len(r.reactants)):
-                    # Find the column into which the fragments goes: if background mark external
-                    try:
-                        j=self.species.index(r.reactants[rea])  # Get the product species index of the correct column
-                    except:
-                        continue
-            
-                    multiplier=r.r_mult[rea] # Get the reaction multiplier for the density
-
-                    if self.species[i]==r.reactants[rea]:   # If the species (row index) is a reactant, r is a depletion process 
-                        ''' DEPLETION '''
-
-                        if mode=='diagnostic':
-                            ''' Diagnostic matrix '''
-                            ret[i][i].append('-'+str(multiplier)+'*'+r.database+'_'+r.name+bg)   # Print the rate to the correct element
-
-                        elif mode=='R':
-                            ''' Rate coefficient matrix '''
-                            ret[i,i]-=multiplier*r.rate(Te,Ti,E,ne) # Calculate the Rate coefficient and store appropriately
-
-                        elif mode=='M':
-                            ''' Rate matrix '''
-                            ret[i,i]-=multiplier*r.rate(Te,Ti,E,ne)*bg # Calculate the rate and store appropriately
-
-                for frag in range(len(r.fragments)):    # Loop through the reaction fragments
-                    ''' SOURCE '''
-                    multiplier=r.f_mult[frag]   # Fragment multiplier
-
-                    # Do nothing if background fragment
-                    if r.fragments[frag] not in self.species: 
-                        continue
-                    
-                    # If fragment enters row, add in appropriate column as defined by reactant
-                    elif self.species.index(r.fragments[frag])==i:
-                            if j is None: # External flag triggered, store to external source
-                                ''' EXTERNAL SOURCE '''
-
-                                if mode=='diagnostic':
-                                    ''' Diagnostic matrix '''
-                                    ext_source[i].append('+'+str(multiplier)+'*'+r.database+'_'+r.name+bg)
-
-                                elif mode=='R':
-                                    ''' Rate coefficient matrix '''
-                                    ext_source[i]+=multiplier*r.rate(Te,Ti,E,ne)
-
-                                elif mode=='M':
-                                    ''' Rate matrix '''
-                                    ext_source[i]+=multiplier*r.rate(Te,Ti,E,ne)*bgm
-
-                                elif mode=='Sgl':
-                                    ''' Energy source matrix in Greenland form '''
-                                    ext_source[i,:]+=r.rate(Te,Ti,E,ne)*bgm*Sgl[:,0]+Sgl[:,1]
-            
-                                elif mode=='I':
-                                    ''' Intensity matrix '''
-                                    ext_source[i,:]+=r.rate(Te,Ti,E,ne)*bgm*I[:,0]
-
-                                elif mode=='E':
-                                    ''' Intensity matrix '''
-                                    ext_source[i,:]+=I[:,0]
-
-
-                            else: # No trigger of external source, store to appropriate location in matrix
-                                ''' INTERNAL SOURCE '''
-
-                                if mode=='diagnostic':
-                                    ''' Diagnostic matrix '''
-                                    ret[i][j].append('+'+str(multiplier)+'*'+r.database+'_'+r.name+bg)
-                            
-                                elif mode=='R':
-                                    ''' Rate coefficient matrix '''
-                                    ret[i,j]+=multiplier*r.rate(Te,Ti,E,ne)
-
-                                elif mode=='M':
-                                    ''' Rate matrix '''
-                                    ret[i,j]+=multiplier*r.rate(Te,Ti,E,ne)*bg
-
-                                elif mode=='Sgl': 
-                                    ''' Energy source matrix in Greenland form '''
-                                    ret[i,j,:]+=r.rate(Te,Ti,E,ne)*bg*Sgl[:,0]+Sgl[:,1]
-
-                                elif mode=='I':
-                                    ''' Correlation matrix '''    
-                                    ret[i,j,:]+=r.rate(Te,Ti,E,ne)*bg*(abs(I[:,0])>0)
-                                    #ret[i,j]=1
-
-                                elif mode=='E':
-                                    ''' Correlation matrix '''    
-                                    ret[i,j,:]+=I[:,0]
-                                    
         return ret,ext_source
 
         
     def write_matrix(self,mat,ext,char,te,ne,ti,ni,E,form='{:1.1E}'):
-        ''' Writes the matrix mat to a file and outputs to stdout, if requested
+        ''' Queues the matrix mat to be written to logs/char_matrix.npz, unless running without I/O
             write_matrix(mat,ext,char,te,ne,ti,ni,E)
             
             mat     -   NxN matrix to be written
@@ -322,57 +916,94 @@ class CRM:
             ti      -   Ion temperature for header [ev]
             ni      -   Ion density for header [cm**-3]
 
+            Optional parameters
+            form ('{:1.1E}')    -   Format of the elements when rendered as text, see render_matrix
         '''
         from os import getcwd
         from datetime import datetime
 
+        if not self.io: return
+
+        # Write the arrays in binary, the text is only rendered on demand
+        self.logger.write('{}_matrix'.format(char),mat=mat,ext=ext,state=[te,ne,ti,ni,E],form=form,
+                        header='CRUM run in {} on {}'.format(getcwd(),str(datetime.now())[:-7]))
+
+
+    def render_matrix(self,char,write=True):
+        ''' Renders the matrix logged by write_matrix as text
+            render_matrix(char,*keys)
+
+            char    -   Character to be identify the matrix in the file name
+
+            Optional parameters
+            write (True)    -   Write the text to logs/char_matrix.log
+
+            Returns
+            The tabulated matrix as a string
+        '''
+        log=self.logger.read('{}_matrix'.format(char))
+        mat,ext,form,run=log['mat'],log['ext'],str(log['form']),str(log['header'])
+        te,ne,ti,ni,E=log['state']
+
         Slabels=['S_e','S_ia','S_V','S_g']
 
-        with open('logs/{}_matrix.log'.format(char),'w') as f:  # Create a file to write to according to char
-            
-            if char=='R': # Rate coefficient  matrix is being written
-                f.write('Diagnostic rate coefficient (density-independend) matrix for CRUM run in {} on {}\n'.format(getcwd(),str(datetime.now())[:-7]))
-                f.write('Te={} eV, Ti={} eV, E={} eV\n'.format(te,ti,E))
-            elif char=='M': # Rate matrix is being written
-                f.write('Diagnostic rate (density-dependend) matrix for CRUM run in {} on {}\n'.format(getcwd(),str(datetime.now())[:-7]))
-                f.write('Te={} eV, Ti={} eV, ne={} 1/cm**3, ni={} 1/cm**3, E={} eV\n'.format(te,ti,ne,ni,E))
-            elif char=='S': # Rate matrix is being written
-                f.write('Diagnostic energy loss (density-dependend) matrix for CRUM run in {} on {}\n'.format(getcwd(),str(datetime.now())[:-7]))
-                f.write('Te={} eV, Ti={} eV, ne={} 1/cm**3, ni={} 1/cm**3, E={} eV\n'.format(te,ti,ne,ni,E))
-            
-            # Create header line
-            out='{}-MAT|'.format(char.upper()).rjust(10) 
-            for s in self.species:
-                out+=s.rjust(10,' ')
-            f.write(out+'\n'+'_'*(1+len(self.species))*10+'\n')
-
-            # Loop through the matrix
-            for l in range(len(mat)):
-                if len(mat)==len(self.species):
-                    out=self.species[l]+'|' # Create a tabulated file with the row species displayed
+        if char=='R': # Rate coefficient  matrix is being written
+            ret='Diagnostic rate coefficient (density-independend) matrix for {}\n'.format(run)
+            ret+='Te={} eV, Ti={} eV, E={} eV\n'.format(te,ti,E)
+        elif char=='M': # Rate matrix is being written
+            ret='Diagnostic rate (density-dependend) matrix for {}\n'.format(run)
+            ret+='Te={} eV, Ti={} eV, ne={} 1/cm**3, ni={} 1/cm**3, E={} eV\n'.format(te,ti,ne,ni,E)
+        elif char=='S': # Rate matrix is being written
+            ret='Diagnostic energy loss (density-dependend) matrix for {}\n'.format(run)
+            ret+='Te={} eV, Ti={} eV, ne={} 1/cm**3, ni={} 1/cm**3, E={} eV\n'.format(te,ti,ne,ni,E)
+        else:
+            ret=''
+        
+        # Create header line
+        out='{}-MAT|'.format(char.upper()).rjust(10) 
+        for s in self.species:
+            out+=s.rjust(10,' ')
+        ret+=out+'\n'+'_'*(1+len(self.species))*10+'\n'
+
+        # Loop through the matrix
+        for l in range(len(mat)):
+            if len(mat)==len(self.species):
+                out=self.species[l]+'|' # Create a tabulated file with the row species displayed
+            else:
+                out=Slabels[l]+'|' # Create a tabulated file with the row species displayed
+            out=out.rjust(10,' ')
+            # Add each element to the line with 10 characters reserved
+            for e in mat[l,:]:
+                if e==0:
+                    out+=' '*9+'_'
                 else:
-                    out=Slabels[l]+'|' # Create a tabulated file with the row species displayed
-                out=out.rjust(10,' ')
-                # Add each element to the line with 10 characters reserved
-                for e in mat[l,:]:
-                    if e==0:
-                        out+=' '*9+'_'
-                    else:
-                        out+=form.format(e).rjust(10,' ')
-                f.write(out+'\n')
-            # Write the external source to the bottom of the output
-            f.write('_'*(1+len(self.species))*10+'\n')
-            out='S_ext|'.rjust(10,' ')
-            for s in ext:
-                out+=form.format(s).rjust(10,' ')
-            f.write(out)
+                    out+=form.format(e).rjust(10,' ')
+            ret+=out+'\n'
+        # Write the external source to the bottom of the output
+        ret+='_'*(1+len(self.species))*10+'\n'
+        out='S_ext|'.rjust(10,' ')
+        for s in ext:
+            out+=form.format(s).rjust(10,' ')
+        ret+=out
+
+        if write:
+            with open('logs/{}_matrix.log'.format(char),'w') as f:
+                f.write(ret)
+        return ret
 
 
 
     def DIAGNOSTIC(self):
-        ''' Returns a diagnostic matrix containing lists of reactions accounted for in each element '''
-        from os import getcwd
+        ''' Writes a diagnostic matrix containing lists of reactions accounted for in each element 
+            to logs/reaction_matrix.log. Skipped on setup if running without I/O.
+        '''
+        from os import getcwd,mkdir
         from datetime import datetime
+
+        try: # Ensure that there is a logs directory, also when running without I/O
+            mkdir('logs')
+        except:
+            pass
  
         dia,ext=self.populate('diagnostic',0,'*[ne]',0,'*[ni]') # Get the 2D diagnostic list and external source list
 
@@ -411,7 +1042,11 @@ class CRM:
             Ti (None)       -   Background plasma ion temperature [eV]. Ti=Te if Ti is None
             E (0.1)         -   Target particle energy [eV]
             sparse (False)  -   Switch for returning the matrix as a csc matrix
-            write (True)    -   Write the rate coefficient matrix to file
+            write (True)    -   Log the matrix, see write_matrix
+
+            Te, Ti and E can be arrays, in which case the matrices of all points are returned
+            stacked along the leading axes. Batches are not written to file, and are returned
+            as lists of csc matrices if sparse.
 
             Returns
             R,ext
@@ -424,12 +1059,14 @@ class CRM:
         ni,ne=1,1 # Set densities to one to get rate coefficients as output
         R,ext=self.populate('R',Te,0,Ti,0,E)
     
+        if R.ndim>2: # Batch of matrices
+            if sparse: R=[csc_matrix(x) for x in R.reshape((-1,)+R.shape[-2:])]
+            return R,ext
+
         if write: # Write to log if requested
             self.write_matrix(R,ext,'R',Te,0,Ti,0,E)
-            if self.verbose: # Print rate matrix to stdout if running verbose
-                with open('logs/R_matrix.log','rt') as f:
-                    for l in f:
-                        print(l.strip())
+            if self.verbose and self.io: # Print rate matrix to stdout if running verbose
+                print(self.render_matrix('R',False))
         
         if sparse: R=csc_matrix(R)  # Use sparse format if requested
 
@@ -438,17 +1075,26 @@ class CRM:
 
 
 
-    def M(self,Te,ne,Ti=None,ni=None,E=0.1,sparse=False,write=True):
+    def M(self,Te,ne,Ti=None,ni=None,E=0.1,sparse=False,write=True,copy=True):
         ''' Creates the rate  matrix
             M(Te,*keys)
 
             Te              -   Background plasma electron temperature [eV]
+            ne              -   Background plasma electron density [cm**-3]
 
             Optional parameters
             Ti (None)       -   Background plasma ion temperature [eV]. Ti=Te if Ti is None
+            ni (None)       -   Background plasma ion density [cm**-3]. ni=ne if ni is None
             E (0.1)         -   Target particle energy [eV]
             sparse (False)  -   Switch for returning the matrix as a csc matrix
-            write (True)    -   Write the rate coefficient matrix to file
+            write (True)    -   Log the matrix, see write_matrix
+            copy (True)     -   Return writable copies. If False, the read-only arrays cached in 
+                                the evaluation context of the state are returned, which are shared
+                                by all calls for the state (see CONTEXT)
+
+            Te, ne, Ti, ni and E can be arrays, in which case the matrices of all points are 
+            returned stacked along the leading axes, e.g. (K,N,N) and (K,N) for K points. 
+            Batches are not written to file, and are returned as lists of csc matrices if sparse.
 
             Returns
             M,ext
@@ -460,115 +1106,103 @@ class CRM:
         if Ti is None: Ti=Te # Check for Ti, set if necessary
         if ni is None: ni=ne # Check for ni, set if necessary
 
-        M,ext=self.populate('M',Te,ne,Ti,ni,E)
+        M,ext=self.context(Te,ne,Ti,ni,E).matrix() # Shared by all matrices of the state
+        if copy: M,ext=M.copy(),ext.copy()
+
+        if M.ndim>2: # Batch of matrices
+            if sparse: M=[csc_matrix(x) for x in M.reshape((-1,)+M.shape[-2:])]
+            return M,ext
 
         if write:   # Write to log if requested
             self.write_matrix(M,ext,'M',Te,ne,Ti,ne,E)
-            if self.verbose: # Print output if running verbose
-                with open('logs/M_matrix.log','rt') as f:
-                    for l in f:
-                        print(l.strip())
+            if self.verbose and self.io: # Print output if running verbose
+                print(self.render_matrix('M',False))
         
         if sparse: M=csc_matrix(M) # Use sparse format if requested
     
         return M,ext
  
-    def Sgl(self,Te,ne,Ti=None,ni=None,E=0.1,rad=True,Tm=False,write=False,Ton=True):
-        from numpy import matmul,block
-        from numpy.linalg import inv
+    def Sgl(self,Te,ne,Ti=None,ni=None,E=0.1,rad=True,Tm=False,write=False,Ton=True,copy=True):
+        ''' Returns the Greenland-reduced energy matrices and sources of the channels el, ia, V, ga
+            and gm. The sources are the read-only arrays of the evaluation context unless copy, see M
+        '''
         if Ti is None: Ti=Te # Check for Ti, set if necessary
         if ni is None: ni=ne # Check for ni, set if necessary
 
-        mat,ext=self.populate('Sgl',Te,ne,Ti,ni,E,Tm=Tm,rad=rad,Ton=Ton)    
+        ctx=self.context(Te,ne,Ti,ni,E,Tm,rad)
+        mat,ext=ctx.matrix('Sgl',Ton)
 
 
-        if write:
+        if write and mat.ndim==3:
             title=['Sgl_el','Sgl_ia','Sgl_v','Sgl_ga','Sgl_gm']
             for i in range(5):
                 self.write_matrix(mat[:,:,i],ext[:,i],title[i],Te,ne,Ti,ni,E,form='{:1.2E}')
 
         
-        U=[ [mat[:,:,0], ext[:,0]],
-            [mat[:,:,1], ext[:,1]],
-            [mat[:,:,2], ext[:,2]],
-            [mat[:,:,3], ext[:,3]],
-            [mat[:,:,4], ext[:,4]], ]
-
-
-        M,G=self.M(Te,ne,Ti,ni,E,write=write) # Get the full rate matrix
-
-        MP=M[:self.Np,:self.Np]
-        MQ=M[self.Np:,self.Np:]
-        V=M[self.Np:,:self.Np]
-        H=M[:self.Np,self.Np:]
-        
+        M,G=ctx.matrix() # Get the full rate matrix
+        if write: self.M(Te,ne,Ti,ni,E,write=write)
+        _,_,U=self.gl_reduce(M,U=mat) # Reduce all energy channels at once
 
-        ret=[]
-        for S in U:
-            UP=S[0][:self.Np,:self.Np]
-            UQ=S[0][self.Np:,self.Np:]
-            UV=S[0][self.Np:,:self.Np]
-            UH=S[0][:self.Np,self.Np:]
-
-            P=UP-matmul(UH,matmul(inv(MQ),V))
-            Q=UV-matmul(UQ,matmul(inv(MQ),V))
-            
-            ret.append([block( [ [P],[Q]]),S[1]])
-
-            
-        return ret
+        if copy: ext=ext.copy()
+        return [[U[...,i,:,:],ext[...,i]] for i in range(5)]
 
-    def S(self,Te,ne,Ti=None,ni=None,E=0.1,rad=True,Tm=False,write=False,Ton=True):
+    def S(self,Te,ne,Ti=None,ni=None,E=0.1,rad=True,Tm=False,write=False,Ton=True,copy=True):
+        ''' Returns the energy matrices and sources of the channels el, ia, V, ga and gm. The arrays
+            are the read-only arrays of the evaluation context unless copy, see M
+        '''
         if Ti is None: Ti=Te # Check for Ti, set if necessary
         if ni is None: ni=ne # Check for ni, set if necessary
 
-        mat,ext=self.populate('Sgl',Te,ne,Ti,ni,E,Tm=Tm,rad=rad,Ton=Ton)    
+        mat,ext=self.context(Te,ne,Ti,ni,E,Tm,rad).matrix('Sgl',Ton)
+        if copy: mat,ext=mat.copy(),ext.copy()
 
 
-        if write:
+        if write and mat.ndim==3:
             title=['Sgl_el','Sgl_ia','Sgl_v','Sgl_ga','Sgl_gm']
             for i in range(5):
                 self.write_matrix(mat[:,:,i],ext[:,i],title[i],Te,ne,Ti,ni,E,form='{:1.2E}')
 
-        return  [   [mat[:,:,0], ext[:,0]],
-                    [mat[:,:,1], ext[:,1]],
-                    [mat[:,:,2], ext[:,2]],
-                    [mat[:,:,3], ext[:,3]],
-                    [mat[:,:,4], ext[:,4]], ]
+        return  [   [mat[...,0], ext[...,0]],
+                    [mat[...,1], ext[...,1]],
+                    [mat[...,2], ext[...,2]],
+                    [mat[...,3], ext[...,3]],
+                    [mat[...,4], ext[...,4]], ]
 
 
-    def I(self,Te,ne,Ti=None,ni=None,E=0.1,rad=True,Tm=False,write=False,Ton=True):
-        ''' Creates a radiaiton intensity matrix '''
+    def I(self,Te,ne,Ti=None,ni=None,E=0.1,rad=True,Tm=False,write=False,Ton=True,copy=True):
+        ''' Creates a radiaiton intensity matrix, the read-only array of the evaluation context unless copy, see M '''
         if Ti is None: Ti=Te # Check for Ti, set if necessary
         if ni is None: ni=ne # Check for ni, set if necessary
 
-        mat,ext=self.populate('I',Te,ne,Ti,ni,E,Tm=Tm,rad=rad,Ton=Ton)    
-        if write:
+        mat,ext=self.context(Te,ne,Ti,ni,E,Tm,rad).matrix('I',Ton)
+        if copy: mat,ext=mat.copy(),ext.copy()
+        if write and mat.ndim==3:
             title=['Ia','Im']
             for i in range(5):
                 self.write_matrix(mat[:,:,i],ext[:,i],title[i],Te,ne,Ti,ni,E,form='{:1.2E}')
 
 
-        return  [   [mat[:,:,0], ext[:,0]],
-                    [mat[:,:,1], ext[:,1]] ]
+        return  [   [mat[...,0], ext[...,0]],
+                    [mat[...,1], ext[...,1]] ]
 
 
-    def E(self,Te,ne,Ti=None,ni=None,E=0.1,rad=True,Tm=False,write=False,Ton=True):
-        ''' Creates a radiaiton intensity matrix '''
+    def E(self,Te,ne,Ti=None,ni=None,E=0.1,rad=True,Tm=False,write=False,Ton=True,copy=True):
+        ''' Creates a radiaiton intensity matrix, the read-only array of the evaluation context unless copy, see M '''
         if Ti is None: Ti=Te # Check for Ti, set if necessary
         if ni is None: ni=ne # Check for ni, set if necessary
 
-        mat,ext=self.populate('E',Te,ne,Ti,ni,E,Tm=Tm,rad=rad,Ton=Ton)    
+        mat,ext=self.context(Te,ne,Ti,ni,E,Tm,rad).matrix('E',Ton)
+        if copy: mat,ext=mat.copy(),ext.copy()
 
 
-        if write:
+        if write and mat.ndim==3:
             title=['Ea','Em']
             for i in range(5):
                 self.write_matrix(mat[:,:,i],ext[:,i],title[i],Te,ne,Ti,ni,E,form='{:1.2E}')
 
 
-        return  [   [mat[:,:,0], ext[:,0]],
-                    [mat[:,:,1], ext[:,1]] ]
+        return  [   [mat[...,0], ext[...,0]],
+                    [mat[...,1], ext[...,1]] ]
 
 
     def ddt(self,t,n,mat,ext):
@@ -577,126 +1211,167 @@ class CRM:
         
             t   -   Time of evaluation [s]
             n   -   Vector of initial density distribution [cm**-3]
-            mat -   Rate matrix
+            mat -   Rate matrix, dense or sparse
             ext -   External source vector
         '''
-        from numpy import matmul
-
-        return matmul(mat,n)+ext
-
+        return mat@n+ext
 
 
-        
-    def dEdt(self,t,Te,ne,Ti=None,ni=None,E=0.1,Tm=False,rad=True,Sext=True,write=False,gl=True,n=None,Qres=True,Ton=True):
-        from numpy import block,zeros,matmul,reshape,sum
-        from  numpy.linalg import inv
-        from scipy.integrate import solve_ivp
-
-        N=len(self.species)
-        Np=self.Np
-        Nq=N-Np  
-
 
         
+    def dEdt(self,t,Te,ne,Ti=None,ni=None,E=0.1,Tm=False,rad=True,Sext=True,write=False,gl=True,n=None,Qres=True,Ton=True,method='exact',rtol=1e-3,atol=1e-6,steady=None):
+        ''' Solves the density evolution and the energy transfer channels of the CRM
+            dEdt(t,Te,ne,*keys)
 
-        M,G=self.M(Te,ne,Ti,ni,E,write=write) # Get the full rate matrix
+            t       -   Final time of the solution, or array of the times of the solution [s]
+            Te      -   Background plasma electron temperature [eV]
+            ne      -   Background plasma electron density [cm**-3]
 
-        ret=[]
-        if gl is True:
-            if n is None:
-                n0=self.n0
-            else:
-                n0=n
-            # Create block matrix from M
-            MP=M[:self.Np,:self.Np]
-            MQ=M[self.Np:,self.Np:]
-            V=M[self.Np:,:self.Np]
-            H=M[:self.Np,self.Np:]
-
-            Meff,GPp,nP0p=self.gl_crm(M,G,Sext,n0)
-        
-            U=self.Sgl(Te,ne,Ti,ni,E,rad,Tm,write=write,Ton=Ton)
+            Optional parameters
+            Ti (None)   -   Background plasma ion temperature [eV]. Ti=Te assumed if None
+            ni (None)   -   Background plasma ion density [cm**-3]. ni=ne assumed if None
+            E (0.1)     -   Target particle energy [eV]
+            Tm (False)  -   Molecular temperature [eV], see S
+            rad (True)  -   Include radiation, see S
+            Sext (True) -   Include external source (from background plasma reactions into CRM species)
+            write (False)   -   Write the matrices to file
+            gl (True)   -   Switch for solving the Greenland P-space problem rather than the full problem
+            n (None)    -   Initial distribution of particeles, taken as n0 specified in input if None.
+                            A vector containing the initial energies of the channels followed by the 
+                            (P-space) densities is also accepted. Raises a ValueError for other lengths
+            Qres (True) -   Switch for resolving the energy channels by species
+            Ton (True)  -   See S
+            method ('exact')    -   Solution method of the densities, 'exact' or a stiff solve_ivp method, see integrate
+            rtol (1e-3)         -   Relative tolerance of the integration
+            atol (1e-6)         -   Absolute tolerance of the integration
+            steady (None)       -   Tolerance of the opt-in steady-state event, see integrate [1/s].
+                                    Unless 'exact', the stopping time depends on method and rtol
 
+            Returns
+            DEPOSITION object, whose sol(t) returns the 5 energy channels el, ia, V, ga and gm 
+            (each resolved by species if Qres) stacked on top of the densities. Only the densities
+            are solved for, and the channels are accumulated from their time-integral
+        '''
+        from numpy import zeros,concatenate,sum
 
-            if Qres is True:
+        N=len(self.species)
+        Np=self.Np
 
-                mat=block(  [   [zeros((N,5*N)),     U[0][0]],
-                                [zeros((N,5*N)),     U[1][0]],
-                                [zeros((N,5*N)),     U[2][0]],
-                                [zeros((N,5*N)),     U[3][0]],
-                                [zeros((N,5*N)),     U[4][0]],
-                                [zeros((Np,5*N)),     Meff]   ])
-                if n is None:
-                    n=zeros((len(mat),))
-                    n[-Np:]=nP0p
-                ext=block([U[0][1], U[1][1], U[2][1], U[3][1], U[4][1], GPp])
+        M,G=self.M(Te,ne,Ti,ni,E,write=write,copy=False) # Get the full rate matrix
 
-            else:
+        if gl is True:
+            Nd=Np # Number of densities
+            U=self.Sgl(Te,ne,Ti,ni,E,rad,Tm,write=write,Ton=Ton,copy=False)
+        else:
+            Nd=N
+            U=self.S(Te,ne,Ti,ni,E,rad,Tm,write=True,Ton=Ton,copy=False)
 
-                mat=block(  [   [zeros((5,)),      sum(U[0][0],axis=0)],
-                                [zeros((5,)),      sum(U[1][0],axis=0)],
-                                [zeros((5,)),      sum(U[2][0],axis=0)],
-                                [zeros((5,)),      sum(U[3][0],axis=0)],
-                                [zeros((5,)),      sum(U[4][0],axis=0)],
-                                [zeros((Np,5)),   Meff]   ])
+        # Energy rates per density and constant energy rates of the channels
+        if Qres is True:
+            Q=concatenate([U[i][0] for i in range(5)])
+            q=concatenate([U[i][1] for i in range(5)])
+        else:
+            Q=concatenate([sum(U[i][0],axis=0,keepdims=True) for i in range(5)])
+            q=[sum(U[i][1]) for i in range(5)]
 
-                if n is None:
-                    n=zeros((len(mat),))
-                    n[-Np:]=nP0p
-                ext=block([sum(U[0][1],axis=0), sum(U[1][1],axis=0), sum(U[2][1],axis=0), sum(U[3][1],axis=0), sum(U[4][1],axis=0), GPp])
-                
+        E0,nd=zeros((len(Q),)),None
+        if n is None: n=self.n0
+        elif len(n)==len(Q)+Nd and len(n)!=N: # Initial energies and densities given
+            E0,nd,n=n[:-Nd],n[-Nd:],self.n0
+        elif len(n)!=N:
+            raise ValueError('n must contain {} densities, or {} energies followed by {} densities, not {} entries'.format(N,len(Q),Nd,len(n)))
+        mat,ext,n0=self.gl_crm(M,G,Sext,n) if gl is True else (M,G,n)
+        if nd is None: nd=n0
 
-     
+        # Only the densities relax to a steady state, the energy channels keep accumulating
+        return DEPOSITION(self.integrate(mat,ext,nd,t,method,rtol,atol,steady=steady),Q,q,E0)
 
-        else:
-             
-            if Qres is True:
-                U=self.S(Te,ne,Ti,ni,E,rad,Tm,write=True,Ton=Ton)
-    
+        
 
-                mat=block(  [   [zeros((N,5*N)),        U[0][0]],
-                                [zeros((N,5*N)),        U[1][0]],
-                                [zeros((N,5*N)),        U[2][0]],
-                                [zeros((N,5*N)),        U[3][0]],
-                                [zeros((N,5*N)),        U[4][0]],
-                                [zeros((N,5*N)),        M]   ])
-                if n is None:
-                    n=zeros((len(mat),))
-                    n[-N:]=self.n0
-                ext=block([U[0][1], U[1][1], U[2][1], U[3][1], U[4][1], G])
+    #def gl_E(self,mat,ext,Sext=True,n=None,matrices=False):
 
-            else:
-                U=self.S(Te,ne,Ti,ni,E,rad,Tm,write=True,Ton=Ton)
 
-                mat=block(  [   [zeros((5,)),      sum(U[0][0],axis=0)],
-                                [zeros((5,)),      sum(U[1][0],axis=0)],
-                                [zeros((5,)),      sum(U[2][0],axis=0)],
-                                [zeros((5,)),      sum(U[3][0],axis=0)],
-                                [zeros((5,)),      sum(U[4][0],axis=0)],
-                                [zeros((N,5)),    M]   ])
+    def gl_reduce(self,mat,ext=None,U=None):
+        ''' Returns the Greenland reduction of a rate matrix, or a stack of rate matrices
+            gl_reduce(mat,*keys)
 
-                if n is None:
-                    n=block([   zeros((5,)), self.n0    ] )
+            mat         -   Rate matrix, or stack of rate matrices of shape (...,N,N)
 
-                n=n.reshape((N+5,))
+            Optional parameters
+            ext (None)  -   External source, shape (...,N), to reduce to the P-space. Several sources
+                            can be reduced at once by stacking them along the last axis, (...,N,m)
+            U (None)    -   Energy matrices of the Greenland channels, shape (...,N,N,5), to reduce
 
-                ext=block([sum(U[0][1],axis=0), sum(U[1][1],axis=0), sum(U[2][1],axis=0), sum(U[3][1],axis=0), sum(U[4][1],axis=0), G])
+            MQ is factorized once per matrix, and the Schur complements of the rate matrix, the
+            source and all energy channels are obtained from one batched solve, without inverting MQ.
+            If mat is the rate matrix of a kept context, and ext None or its source, the solution of 
+            the context is reused, see CONTEXT.reduction.
 
-        return solve_ivp(lambda x,y: self.ddt(x,y,mat,ext),(0,t),n,'LSODA',dense_output=True)
+            Returns
+            Meff,GPp,Ugl
+            Meff        -   Effective rate matrix, (...,Np,Np)
+            GPp         -   Effective P-space source GP-H*inv(MQ)*GQ, (...,Np) or (...,Np,m), 
+                            None if ext is None
+            Ugl         -   Reduced energy matrices [UP-UH*inv(MQ)*V; UV-UQ*inv(MQ)*V] of the channels,
+                            (...,5,N,Np), None if U is None
+        '''
+        from numpy import concatenate,moveaxis
+        from numpy.linalg import solve
 
+        Np=self.Np
+        # Create block matrix from M
+        MP=mat[...,:Np,:Np]
+        MQ=mat[...,Np:,Np:]
+        V=mat[...,Np:,:Np]
+        H=mat[...,:Np,Np:]
         
+        # Solve MQ*X=[V,GQ] for all right-hand sides at once
+        GPp=None
+        ctx=self.find_context(mat)
+        if ctx is not None and (ext is None or ext is ctx.matrix()[1]):
+            X=ctx.reduction()
+            if ext is not None:
+                GPp=ext[...,:Np]-(H@X[...,Np:])[...,0]
+        elif ext is not None:
+            vector=ext.ndim<mat.ndim # Single source
+            if vector: ext=ext[...,None]
+            X=solve(MQ,concatenate([V,ext[...,Np:,:]],axis=-1))
+            GPp=ext[...,:Np,:]-H@X[...,Np:]
+            if vector: GPp=GPp[...,0]
+        else:
+            X=solve(MQ,V)
 
-    #def gl_E(self,mat,ext,Sext=True,n=None,matrices=False):
+        Meff=MP-H@X[...,:Np]
+        Ugl=None
+        if U is not None:
+            Uc=moveaxis(U,-1,-3) # Channels first
+            Ugl=Uc[...,:Np]-Uc[...,Np:]@X[...,None,:,:Np]
+        return Meff,GPp,Ugl
 
 
-    def gl_crm(self,mat,ext,Sext=True,n=None,matrices=False):
+    def gl_crm(self,mat,ext,Sext=True,n=None,matrices=False,eigen=False,nsolve=False):
         ''' Returns the P-space matrices according to Greenland 2001
-            gl_crm(ne,*keys)
+            gl_crm(mat,ext,*keys)
+
+            mat         -   Rate matrix, or stack of rate matrices (...,N,N) unless eigen or matrices
+            ext         -   External source vector, (...,N)
 
             Optional parameters
             Sext (True) -   Include external source (from background plasma reactions into CRM species)
-            n (None)    -   Initial distribution of particeles, taken as n0 specified in input if None
+            n (None)    -   Initial distribution of particeles, taken as n0 specified in input if None.
+                            A (...,N,K) block of K distributions is projected at once, giving (...,Np,K)
             matrices (False)    -   Switch determining whether to return the CRM or the matrices
+            eigen (False) - Switch for projecting the source and initial densities using the
+                            eigenvectors of mat, for a single rate matrix. By default, the source
+                            is obtained from linear solves on the MQ block, see gl_reduce:
+                                GPp=GP-H*inv(MQ)*GQ
+                            and the initial densities are projected using the eigenvectors of
+                            (each) mat, T, if they contain Q-space densities:
+                                nP0p=nP-Delta*inv(TQ)*nQ
+            nsolve (False)  -   Switch for projecting the initial densities by linear solves on 
+                            the MQ block instead, nP0p=nP-H*inv(MQ)*nQ, avoiding the 
+                            eigendecomposition. This differs from the eigenvector projection 
+                            by 10-30% when n contains Q-space densities
 
             Returns (matrices=False)
             Meff,GPp,nP0p
@@ -712,19 +1387,32 @@ class CRM:
             D           -   The diagonalized eigenvalue matrix
 
         '''
-        from numpy import matmul,diag,real
-        from numpy.linalg import inv,eig
+        from numpy import matmul,diag,real,any,broadcast_to,asarray,take_along_axis
+        from numpy.linalg import inv,eig,solve
 
         if n is None: n=self.n0 # Use input n0 as default unless explict n0 requested
+        n=asarray(n)
         
+        if not (matrices or eigen):
+            Meff,GPp,_=self.gl_reduce(mat,ext)
+            GPp=GPp-(Sext is not True)*ext[...,:self.Np] # Remove the P-space source if requested
+            block=n.ndim>ext.ndim # Block of initial distributions, (...,N,K)
+            nP0p=n[...,:self.Np,:] if block else n[...,:self.Np]
+            if not any(n[...,self.Np:,:] if block else n[...,self.Np:]):
+                return Meff,GPp,nP0p
+            if nsolve is True: # Reduce the Q-space initial densities by solves on MQ
+                return Meff,GPp,self.gl_reduce(mat,n if block else broadcast_to(n,ext.shape))[1]
+            # Project the Q-space initial densities using the eigenvectors of each matrix
+            eigs,T=eig(mat)
+            T=take_along_axis(T,abs(eigs).argsort(axis=-1)[...,None,:],axis=-1) # Increasing magnitude
+            # Delta*inv(TQ), obtained as the solution of TQ^T*X^T=Delta^T
+            DTQ=solve(T[...,self.Np:,self.Np:].swapaxes(-1,-2),T[...,:self.Np,self.Np:].swapaxes(-1,-2)).swapaxes(-1,-2)
+            nQ=n[...,self.Np:,:] if block else n[...,self.Np:,None]
+            nP0p=real(nP0p-(matmul(DTQ,nQ) if block else matmul(DTQ,nQ)[...,0]))
+            return Meff,GPp,nP0p
 
-        # Create block matric from M
-        MP=mat[:self.Np,:self.Np]
-        MQ=mat[self.Np:,self.Np:]
-        V=mat[self.Np:,:self.Np]
-        H=mat[:self.Np,self.Np:]
         # Calculate Meff
-        Meff=(MP-matmul(matmul(H,inv(MQ)),V))
+        Meff,_,_=self.gl_reduce(mat)
 
         # Diagonalize M
         eigs,T=eig(mat)
@@ -768,37 +1456,120 @@ class CRM:
         return matmul(mat,n)+ext
 
 
-    def gl_nt(self,Te,ne,t,Ti=None,ni=None,E=0.1,n=None,Sext=True):
+    def integrate(self,mat,ext,n,t,method='exact',rtol=1e-3,atol=1e-6,sparse=False,steady=None,nd=None):
+        ''' Solves the linear system dn/dt=mat*n+ext for the initial densities n
+            integrate(mat,ext,n,t,*keys)
+
+            mat     -   Constant rate matrix
+            ext     -   Constant external source vector
+            n       -   Initial densities, N vector or NxK block of K initial distributions
+            t       -   Final time of the solution, or array of the times of the solution [s]
+
+            Optional parameters
+            method ('exact')    -   'exact' for the closed-form PROPAGATOR, or a stiff solve_ivp
+                                    method ('BDF', 'Radau' or 'LSODA') integrating with mat as
+                                    the exact Jacobian
+            rtol (1e-3)         -   Relative tolerance of the integration
+            atol (1e-6)         -   Absolute tolerance of the integration
+            sparse (False)      -   Switch for passing the Jacobian to BDF and Radau as a csc
+                                    matrix. The dense Jacobian is as fast or faster for the
+                                    shipped models (N=2 and N=30), sparse may pay off for
+                                    large models with few transitions per state
+            steady (None)       -   Tolerance of the opt-in steady-state event: the solution is
+                                    terminated once |mat*n+ext|/|n|<steady [1/s]. The residual is
+                                    evaluated from the solution, so the solver error rtol*n enters 
+                                    it multiplied by the rates of mat, which reach 1e9 1/s. For 
+                                    tolerances below this noise, the integrated residual only drops
+                                    below steady once the solver error has decayed, and the stopping
+                                    time depends on the method and rtol: e.g. at Te=3 eV, ne=3e12
+                                    and steady=1e-6, 'exact' stops at 0.023 s, 'LSODA' at 0.15 s and
+                                    'BDF' at 1.4 s, whereas all agree within 5% for steady>=0.1.
+                                    Use 'exact' for small tolerances
+            nd (None)           -   Number of trailing (density) entries of n considered by the 
+                                    steady-state event. All entries are considered if None, or
+                                    for blocks of initial distributions integrated by solve_ivp
+
+            Returns
+            PROPAGATOR object or solve_ivp bunch object (with dense output) containing the solution.
+            If the steady state is reached, the time reached and the final state are stored in 
+            t_events and y_events, and the solution ends there. Blocks of initial distributions 
+            add the K axis after N in y, sol and y_events
+        '''
+        from numpy import ndim,array,tile,eye
+        from numpy import kron as kron_dense
+        from numpy.linalg import norm
+        from scipy.integrate import solve_ivp
+        from scipy.sparse import csc_matrix,kron,identity,issparse
+
+        if method=='exact':
+            return PROPAGATOR(mat,ext,n,t,steady=steady,nd=nd)
+
+        n=array(n,dtype=float)
+        if n.ndim>1: # Block of initial distributions: integrate the K systems side by side
+            N,K=n.shape
+            # Block-diagonal Jacobian in the format of the single system
+            J=kron(identity(K),mat,format='csc') if sparse else kron_dense(eye(K),mat.toarray() if issparse(mat) else mat)
+            ret=self.integrate(J,tile(ext,K),n.T.ravel(),t,method,rtol,atol,sparse,steady)
+            unstack=lambda y: y.reshape((K,N)+y.shape[1:]).swapaxes(0,1) # Back to (N,K,...)
+            sol=ret.sol
+            ret.y,ret.sol=unstack(ret.y),lambda x: unstack(sol(x))
+            if ret.y_events is not None: ret.y_events=[y.reshape((-1,K,N)).swapaxes(1,2) for y in ret.y_events]
+            return ret
+
+        # LSODA only supports dense Jacobians
+        J=csc_matrix(mat) if sparse and method!='LSODA' else (mat.toarray() if issparse(mat) else mat)
+        # BDF and Radau reuse a constant Jacobian, LSODA expects it as a callable
+        jac=(lambda x,y: J) if method=='LSODA' else J
+        events=None
+        if steady is not None: # Terminate when the relative residual drops below the tolerance
+            i0=-(nd or len(n))
+            events=lambda x,y: norm(self.ddt(x,y,J,ext)[i0:])-steady*norm(y[i0:])
+            events.terminal=True
+            events.direction=-1
+        # Integrate to the final time, evaluating the requested times if any
+        t_eval=None if ndim(t)==0 else array(t)
+        return solve_ivp(lambda x,y: self.ddt(x,y,J,ext),(0,t if t_eval is None else t_eval[-1]),
+                    n,method,t_eval=t_eval,dense_output=True,events=events,jac=jac,rtol=rtol,atol=atol)
+
+
+    def gl_nt(self,Te,ne,t,Ti=None,ni=None,E=0.1,n=None,Sext=True,method='exact',rtol=1e-3,atol=1e-6,steady=None):
         ''' Solves the Greenland NpxNp problem 
             gl_nt(Te,ne,t,*keys)
             
             Te      -   Background plasma electron temperature [eV]
             ne      -   Background plasma electron density [cm**-3]
+            t       -   Final time of the solution, or array of the times of the solution [s]
 
             Optional parameters
             Ti (None)   -   Background plasma ion temperature [eV]. Ti=Te assumed if None
             ni (None)   -   Background plasma ion density [cm**-3]. ni=ne assumed if None
             E (0.1)     -   Target particle energy [eV]
             Sext (True) -   Include external source (from background plasma reactions into CRM species)
-            n (None)    -   Initial distribution of particeles, taken as n0 specified in input if None
+            n (None)    -   Initial distribution of particeles, taken as n0 specified in input if None.
+                            An NxK block of K distributions returns all K trajectories, y being (N,K,...)
+            method ('exact')    -   Solution method, 'exact' or a stiff solve_ivp method, see integrate
+            rtol (1e-3)         -   Relative tolerance of the integration
+            atol (1e-6)         -   Absolute tolerance of the integration
+            steady (None)       -   Tolerance of the opt-in steady-state event, see integrate [1/s].
+                                    Unless 'exact', the stopping time depends on method and rtol
 
             Returns
-            ivp_solve bunch object containing the time-dependent ODE system solution
+            PROPAGATOR object (or solve_ivp bunch object if integrated) containing the time-dependent
+            solution at the times t (or up to t), with the attributes t, y and sol. If the steady 
+            state is reached, the solution ends there and t_events, y_events hold the time and state
         '''
-        from scipy.integrate import solve_ivp 
-
         if n is None: n=self.n0 # Use input n0 as default unless explict n0 requested
         
-        Meff,GPp,nP0p=self.gl_crm(*self.M(Te,ne,Ti,ni,E,write=False),Sext,n) # Set up Greenland model 
+        Meff,GPp,nP0p=self.gl_crm(*self.M(Te,ne,Ti,ni,E,write=False,copy=False),Sext,n) # Set up Greenland model 
         
         # Solve and return
-        return solve_ivp(lambda x,y: self.dndt(x,y,Meff,GPp),(0,t),nP0p,method='LSODA')
+        return self.integrate(Meff,GPp,nP0p,t,method,rtol,atol,steady=steady)
 
     def evaluate_CRM(self,Te,ne,Ti=None,ni=None,E=0.1,printout=True):
         ''' Evaluates the current CRM '''
         from numpy import matmul
         from numpy.linalg import inv
-        M,T,D=self.gl_crm(*self.M(Te,ne,Ti,ni,E,write=False),matrices=True) # Get matrices and eigenvalues/-vectors
+        M,T,D=self.gl_crm(*self.M(Te,ne,Ti,ni,E,write=False,copy=False),matrices=True) # Get matrices and eigenvalues/-vectors
         TQ,delta=T[self.Np:,self.Np:],T[self.Np:,:self.Np]
         tau=1/abs(D)
         tauPmin=min(tau[:self.Np])
@@ -820,7 +1591,7 @@ class CRM:
         ''' Generates the optimal CRMs per Greenland 2001 '''
         from numpy import array,where,matmul
         from numpy.linalg import inv
-        M,T,D=self.gl_crm(*self.M(Te,ne,Ti,ni,E,write=False),Sext=Sext,n=n,matrices=True) # Get matrices and eigenvalues/-vectors
+        M,T,D=self.gl_crm(*self.M(Te,ne,Ti,ni,E,write=False,copy=False),Sext=Sext,n=n,matrices=True) # Get matrices and eigenvalues/-vectors
         # Construct indicator matrix
         I=abs(T)
         I[I<=kappa]=0
@@ -867,31 +1638,174 @@ class CRM:
 
 
 
-    def full_nt(self,Te,ne,t,Ti=None,ni=None,E=0.1,n=None,Sext=True):
+    def full_nt(self,Te,ne,t,Ti=None,ni=None,E=0.1,n=None,Sext=True,method='exact',rtol=1e-3,atol=1e-6,steady=None):
         ''' Solves the full NxN problem 
             full_nt(Te,ne,t,*keys)
             
             Te      -   Background plasma electron temperature [eV]
             ne      -   Background plasma electron density [cm**-3]
+            t       -   Final time of the solution, or array of the times of the solution [s]
 
             Optional parameters
             Ti (None)   -   Background plasma ion temperature [eV]. Ti=Te assumed if None
             ni (None)   -   Background plasma ion density [cm**-3]. ni=ne assumed if None
             E (0.1)     -   Target particle energy [eV]
             Sext (True) -   Include external source (from background plasma reactions into CRM species)
+            n (None)    -   Initial distribution of particeles, taken as n0 specified in input if None.
+                            An NxK block of K distributions returns all K trajectories, y being (N,K,...)
+            method ('exact')    -   Solution method, 'exact' or a stiff solve_ivp method, see integrate
+            rtol (1e-3)         -   Relative tolerance of the integration
+            atol (1e-6)         -   Absolute tolerance of the integration
+            steady (None)       -   Tolerance of the opt-in steady-state event, see integrate [1/s].
+                                    Unless 'exact', the stopping time depends on method and rtol
+
+            Returns
+            PROPAGATOR object (or solve_ivp bunch object if integrated) containing the time-dependent
+            solution at the times t (or up to t), with the attributes t, y and sol. If the steady 
+            state is reached, the solution ends there and t_events, y_events hold the time and state
+        '''
+        if n is None: n=self.n0 # Use input n0 as default unless explict n0 requested
+
+        mat,ext=self.M(Te,ne,Ti,ni,E,write=False,copy=False) # Get the full rate matrix
+        ext=(Sext is True)*ext  # Set source strength
+        # Solve and return
+        return self.integrate(mat,ext,n,t,method,rtol,atol,steady=steady)
+
+
+
+    def td_nt(self,Te,ne,t,Ti=None,ni=None,E=0.1,n=None,Sext=True,tb=None,points=101,gl=False,method='BDF',rtol=1e-3,atol=1e-6):
+        ''' Solves the full NxN (or Greenland NpxNp) problem in a time-dependent background plasma
+            td_nt(Te,ne,t,*keys)
+
+            Te      -   Background plasma electron temperature [eV]
+            ne      -   Background plasma electron density [cm**-3]
+            t       -   Final time of the solution, or array of the times of the solution [s]
+
+            Optional parameters
+            Ti (None)   -   Background plasma ion temperature [eV]. Ti=Te assumed if None
+            ni (None)   -   Background plasma ion density [cm**-3]. ni=ne assumed if None
+            E (0.1)     -   Target particle energy [eV]
             n (None)    -   Initial distribution of particeles, taken as n0 specified in input if None
+            Sext (True) -   Include external source (from background plasma reactions into CRM species)
+            tb (None)   -   Times of the background plasma tables [s]. Taken as equidistant times 
+                            from 0 to the final time if None
+            points (101)-   Number of background plasma tables if neither tb nor array parameters are given,
+                            at least 2
+            gl (False)  -   Switch for solving the Greenland P-space problem rather than the full problem
+            method ('BDF')  -   Stiff solve_ivp method ('BDF', 'Radau' or 'LSODA')
+            rtol (1e-3)     -   Relative tolerance of the integration
+            atol (1e-6)     -   Absolute tolerance of the integration
+
+            Te, ne, Ti and ni can each be a constant, an array of values at the times tb, or a 
+            callable f(t) which is evaluated at the times tb. The rate matrices of all tables are 
+            assembled in one batch, and the rate matrix and source at any time are interpolated 
+            between the tables by shape-preserving (PCHIP) cubics, which stay between the values of
+            neighbouring tables, so that interpolated rates and sources never change sign. The 
+            interpolated matrix is supplied as the exact Jacobian. The energy channels of dEdt are
+            not available in this mode, dEdt assumes a frozen background.
 
             Returns
-            ivp_solve bunch object containing the time-dependent ODE system solution
+            solve_ivp bunch object (with dense output) containing the time-dependent solution
         '''
-        from scipy.integrate import solve_ivp 
+        from numpy import array,linspace,ndim,clip,broadcast_to
+        from scipy.integrate import solve_ivp
+        from scipy.interpolate import PchipInterpolator
 
         if n is None: n=self.n0 # Use input n0 as default unless explict n0 requested
+        if Ti is None: Ti=Te # Check for Ti, set if necessary
+        if ni is None: ni=ne # Check for ni, set if necessary
+        tend=t if ndim(t)==0 else t[-1]
+
+        # Set up the background plasma tables
+        if tb is None:
+            P=max([len(x) for x in [Te,ne,Ti,ni] if not callable(x) and ndim(x)>0]+[0]) or points
+            tb=linspace(0,tend,P)
+        tb=array(tb,dtype=float)
+        Te,ne,Ti,ni=[broadcast_to(array([x(tt) for tt in tb]) if callable(x) else x,tb.shape).astype(float) 
+                        for x in [Te,ne,Ti,ni]]
+
+        mat,ext=self.M(Te,ne,Ti,ni,E,write=False,copy=False) # Rate matrices of all tables at once
+        if gl is True: # Reduce all tables to the P-space
+            mat,ext,nP0p=self.gl_crm(mat,ext,Sext,broadcast_to(n,ext.shape))
+            n=nP0p[0]
+        else:
+            ext=(Sext is True)*ext  # Set source strength
+        # PCHIP keeps the interpolated matrices smooth, so the solver steps over the tables, without
+        # overshooting steep changes of the background into negative rates
+        Ms,Gs=PchipInterpolator(tb,mat,axis=0),PchipInterpolator(tb,ext,axis=0)
+        interpolate=lambda x: (Ms(clip(x,tb[0],tb[-1])),Gs(clip(x,tb[0],tb[-1])))
+
+        t_eval=None if ndim(t)==0 else array(t)
+        return solve_ivp(lambda x,y: self.ddt(x,y,*interpolate(x)),(0,tend),n,method,t_eval=t_eval,
+                    dense_output=True,jac=lambda x,y: interpolate(x)[0],rtol=rtol,atol=atol)
+
+
+
+    def steady_state(self,Te,ne,Ti=None,ni=None,E=0.1,Sext=True,sparse=None):
+        ''' Solves the full NxN problem for the steady-state densities, M*n=-ext
+            steady_state(Te,ne,*keys)
 
-        mat,ext=self.M(Te,ne,Ti,ni,E,write=False) # Get the full rate matrix
+            Te      -   Background plasma electron temperature [eV]
+            ne      -   Background plasma electron density [cm**-3]
+
+            Optional parameters
+            Ti (None)       -   Background plasma ion temperature [eV]. Ti=Te assumed if None
+            ni (None)       -   Background plasma ion density [cm**-3]. ni=ne assumed if None
+            E (0.1)         -   Target particle energy [eV]
+            Sext (True)     -   Include external source (from background plasma reactions into CRM species)
+            sparse (None)   -   Switch for using a sparse LU factorization. Used if less than a quarter
+                                of M is filled if None. Batches are always solved densely
+
+            Te, ne, Ti, ni and E can be arrays, in which case the steady states of all points are 
+            returned stacked along the leading axes, e.g. (K,N) for K points.
+
+            Returns
+            n,balance
+            n       -   Steady-state densities [cm**-3]
+            balance -   Relative nuclei imbalance of the reactions at the steady state: the rate at
+                        which the reactions, including their background reactants and fragments, 
+                        create nuclei (weighted as in totparticles, see nuclei), relative to the rate 
+                        at which they consume nuclei. Zero for a nuclei-conserving reaction network
+        '''
+        from numpy import array,count_nonzero,maximum,broadcast_arrays,where
+        from numpy.linalg import solve
+        from scipy.sparse import csc_matrix
+        from scipy.sparse.linalg import spsolve
+
+        mat,ext=self.M(Te,ne,Ti,ni,E,write=False,copy=False) # Get the full rate matrix
         ext=(Sext is True)*ext  # Set source strength
-        # Solve and return
-        return solve_ivp(lambda x,y: self.dndt(x,y,mat,ext),(0,t),n,method='LSODA')
+
+        if mat.ndim>2: # Batch of matrices
+            n=solve(mat,-ext[...,None])[...,0]
+        else:
+            if sparse is None: sparse=count_nonzero(mat)<0.25*mat.size
+            n=spsolve(csc_matrix(mat),-ext) if sparse else solve(mat,-ext)
+
+        # Check nuclei conservation of the reactions at the steady-state rates. Unlike the balance of
+        # M*n+ext, which vanishes by construction, this accounts for the background species
+        if Ti is None: Ti=Te # Check for Ti, set if necessary
+        if ni is None: ni=ne # Check for ni, set if necessary
+        Te,ne,Ti,ni,E=broadcast_arrays(Te,ne,Ti,ni,E)
+        Te,ne,Ti,ni,E=[x.ravel() for x in [Te,ne,Ti,ni,E]] # Flatten the batch
+        k=self.rates(Te,Ti,E,ne)
+        bg,bgm=self.densities(ne,ni)
+        nk=n.reshape((-1,len(self.species))).T
+        # Reaction rates: per density of the last reactant in species, as in the matrix, or external
+        last=array([max([self.species.index(x) for x in r.reactants if x in self.species],default=-1)
+                    for r in self.reactions])
+        rate=where(last[:,None]>=0,k*bg*nk[maximum(last,0)],(Sext is True)*k*bgm)
+        # Nuclei consumed and created by each reaction
+        consumed=array([sum(m*self.nuclei(x) for m,x in zip(r.r_mult,r.reactants)) for r in self.reactions])
+        created=array([sum(m*self.nuclei(x) for m,x in zip(r.f_mult,r.fragments)) for r in self.reactions])
+        balance=((created-consumed)@rate)/maximum(consumed@rate,1e-300)
+        balance=balance.reshape(n.shape[:-1])
+
+        return n,balance[()]
+
+
+    def nuclei(self,species):
+        ''' Returns the number of nuclei of a species or background particle, as weighted in totparticles '''
+        return 0 if species=='e' else 1+('H2' in species)
 
 
 
@@ -933,7 +1847,7 @@ class CRM:
         if n is None: n=self.n0 # Use input n0 as default unless explict n0 requested
         NN=len(self.species)*len(self.species)
 
-        mat,ext=self.M(Te,ne,Ti,ni,E,write=write) # Get the full rate matrix
+        mat,ext=self.M(Te,ne,Ti,ni,E,write=write,copy=False) # Get the full rate matrix
         # Solve and return
         ndot=abs(matmul(mat,n)+ext*(Sext is True))
 
@@ -943,8 +1857,8 @@ class CRM:
 
 
 
-        x=self.E(Te,ne,Ti,Te,E,write=False)
-        y=self.I(Te,ne,Ti,Te,E,write=False)
+        x=self.E(Te,ne,Ti,Te,E,write=False,copy=False)
+        y=self.I(Te,ne,Ti,Te,E,write=False,copy=False)
    
 
         if write:
@@ -5,9 +5,9 @@
 
 
 class CRUMPET:
-    def __init__(self,fname='input/CRUM.dat',path='.',vmax=14,nmax=8,verbose=False,NP=2):
+    def __init__(self,fname='input/CRUM.dat',path='.',vmax=14,nmax=8,verbose=False,NP=2,tabulate=None,io=True):
         from CRUM.ratedata import RATE_DATA
-        from CRUM.reactions import REACTION
+        from CRUM.reactions import REACTION,ENERGY
         from CRUM.crm import CRM
         from numpy import zeros
         from os import getcwd
@@ -21,6 +21,9 @@ class CRUMPET:
         nmax (8)    -   Number of atomic electronic levels considered
         verbose (F) -   Display more output
         Np (2)      -   P-space size, chosen as the first Np entries of the 'SPECIES' card
+        tabulate (None) -   Maximum relative error of pretabulated rate coefficients, see CRM.tabulate.
+                            The rate coefficients are evaluated directly if None
+        io (True)   -   Write logs. No logs are written unless requested if False, see CRM
         '''
         self.path=path # Path to CRUM case
 
@@ -78,67 +81,13 @@ class CRUMPET:
 
 
         def getS(energies,ene,X=None,Y=None):
-            sauces=[k[:3] for k in energies]
-            if 'S_e' not in sauces: S_e=None
-
-            dia=[None,None,None,None]
-            ener_s=[None,None,None,None]
-
+            ''' Compiles the energy expressions S_r, S_g, S_V and S_e of a reaction, see ENERGY '''
+            handles=['S_r','S_g','S_V','S_e']
             ret=[0,0,0,0]
 
             for i in energies:
-                st=XY2num(i,X,Y)
-            if st[:3]=='S_r': ener_s[0]=st
-            elif st[:3]=='S_g': ener_s[1]=st
-            elif st[:3]=='S_V': ener_s[2]=st
-            elif st[:3]=='S_e': ener_s[3]=st
-
-
-            for i in energies:
-                st=XY2num(i,X,Y)
-
-                if i[:3] in ['S_r','S_g','S_V','S_e']:
-                    
-
-                    for v in list(ene.keys())[::-1]:
-                        st=st.replace(str(v),str(ene[v]))
-
-                        
-                    
-                    if i[:3]=='S_r': 
-                        dia[0]=st
-                        try:
-                            exec(st,globals())
-                            ret[0]=S_r
-                        except:
-                            ret[0]=st
-                    elif i[:3]=='S_g':
-                        dia[1]=st
-                        try:
-                            exec(st,globals())
-                            ret[1]=S_g
-                        except:
-                            ret[1]=st
-                    elif i[:3]=='S_V':
-                        dia[2]=st
-                        try:
-                            exec(st,globals())
-                            ret[2]=S_V
-                        except:
-                            ret[2]=st
-                    elif i[:3]=='S_e':
-                        dia[3]=st
-                        try:
-                            exec(st,globals())
-                            ret[3]=S_e
-                        except:
-                            ret[3]=st
-
-             
-            #print(energies)
-            #print(ener_s)
-            #print(dia)
-            #print(ret)
+                if i[:3] in handles:
+                    ret[handles.index(i[:3])]=ENERGY(XY2num(i,X,Y).split('=',1)[1],ene)
 
             return ret
 
@@ -243,9 +192,6 @@ class CRUMPET:
                 for el in elst: # Loop through each line
                     ene[el.split('=')[0].strip()]=float(el.split('=')[1].strip()) 
 
-                # Make energy handles available within function
-                locals().update(ene) 
-
 
                 ''' Unknown card, abort '''
             else:
@@ -489,7 +435,9 @@ class CRUMPET:
 
 
         # Setup the crm
-        self.crm=CRM(self.species,reactions,[verbose,self.Np,n0],self.path,recrad=recrad,ionizrad=ionizrad)
+        self.crm=CRM(self.species,reactions,[verbose,self.Np,n0],self.path,recrad=recrad,ionizrad=ionizrad,io=io)
+        if tabulate is not None:
+            self.crm.tabulate(tabulate)
         
 
     def totpart(self,arr,V=1):
@@ -509,7 +457,7 @@ class CRUMPET:
             n_gl(Te,ne,t)
             Te  -   electron background temperature in box [eV]
             ne  -   electron background density in box [cm**-3]
-            t   -   final time of evolution [s]
+            t   -   final time of evolution, or array of times at which to evaluate the densities [s]
 
             Optional parameters
             Ti (None)   -   ion background temperature in box (=Te if None) [eV]
@@ -529,7 +477,7 @@ class CRUMPET:
             n_gl(Te,ne,t)
             Te  -   electron background temperature in box [eV]
             ne  -   electron background density in box [cm**-3]
-            t   -   final time of evolution [s]
+            t   -   final time of evolution, or array of times at which to evaluate the densities [s]
 
             Optional parameters
             Ti (None)   -   ion background temperature in box (=Te if None) [eV]
@@ -543,6 +491,28 @@ class CRUMPET:
         '''
         return self.crm.full_nt(Te,ne,t,Ti,ni,E,n,Sext)
 
+
+    def n_td(self,Te,ne,t,Ti=None,ni=None,E=0.1,n=None,Sext=True,tb=None,gl=False):
+        ''' Calculates the CRM density evolution in a 1cm**3 box with a time-dependent background up to t
+            n_td(Te,ne,t)
+            Te  -   electron background temperature in box: constant, array at times tb or callable Te(t) [eV]
+            ne  -   electron background density in box: constant, array at times tb or callable ne(t) [cm**-3]
+            t   -   final time of evolution, or array of times at which to evaluate the densities [s]
+
+            Optional parameters
+            Ti (None)   -   ion background temperature in box (=Te if None) [eV]
+            ni (None)   -   ion background density in box (=ne if None) [cm**-1]
+            E (0.1)     -   target particle energy [eV]
+            n (None)    -   initial species distribution (=n0 specified in input if None)
+                            Array of same length as species, order according to 'SPECIES' card
+            Sext (True) -   Include external source (from background plasma reactions into CRM species)
+            tb (None)   -   times of the background arrays (equidistant up to t if None) [s]
+            gl (False)  -   Switch for evolving the Greenland P-space densities
+            
+            Uses the CRM function td_nt
+        '''
+        return self.crm.td_nt(Te,ne,t,Ti,ni,E,n,Sext,tb,gl=gl)
+
     def create_UE_rates(self,fname='ue',E=0.1,Sext=True,h0h2=['H(n=1)','H2(v=0)'],Tm=False,Ton=False,rad=False):
         ''' Script that writes UEDGE rates to self.path/fname.dat
             create_UE_rates(fname='uerates')
@@ -551,8 +521,10 @@ class CRUMPET:
             E (0.1)     -   target particle energy [eV]
             Sext (True) -   Include external source (from background plasma reactions into CRM species)
             h0h2 (['H(n=1)','H2(v=0)']) - List of the H0 and H2 at their electronic and vibrational ground state handles used in the input
+
+            All grid points are evaluated at once, using the batched CRM matrices
             '''
-        from numpy import zeros,sum,array
+        from numpy import sum,stack,arange,meshgrid
         from os import mkdir
 
         # Ensure that the CRM format coincides with the assumed format
@@ -565,23 +537,14 @@ class CRUMPET:
             return
 
         # Create deinsty and temperature points in log-log space as in existing UEDGGE rate files
-        ret=zeros((15,60,self.Np,self.Np))
-        retE=zeros((15,60,5,self.Np))
-        ext=zeros((15,60,self.Np))
-        extE=zeros((15,60,5))
+        ne,Te=meshgrid(10**(10+0.5*arange(15)),10**(-1.2+arange(60)/10),indexing='ij') # 15 density and 60 temperature points
         # Calculate the Greenland (Np) space rates for the T-n space
         print('Creating UEDGE rate output')
-        for i in range(15): # 15 density points in log-log space
-            print('    Density step {}/15'.format(i+1))
-            for j in range(60): # 60 temperature points in log-log space
-                print('        Temperature step {}/60'.format(j+1))
-                Te,ne=10**(-1.2+j/10),10**(10+0.5*i)
-                ret[i,j,:,:],ext[i,j,:],_=self.crm.gl_crm(*self.crm.M(Te,ne,Te,ne,E,write=False),Sext=Sext) # Store to matrix
-                U=self.crm.Sgl(Te,ne,Te,ne,E,rad,Tm,write=False,Ton=Ton) # Don't include erl1/erl2 radiation in the rates as these are handled by UEDGE
-                # Include T-losses or not?
-                retE[i,j,:,:]=array([ sum(U[0][0],axis=0), sum(U[1][0],axis=0), sum(U[2][0],axis=0), sum(U[3][0],axis=0), sum(U[4][0],axis=0)])
-                #print(len(retE.shape))
-                extE[i,j,:]=array([ sum(U[0][1],axis=0), sum(U[1][1],axis=0), sum(U[2][1],axis=0), sum(U[3][1],axis=0), sum(U[4][1],axis=0) ])
+        ret,ext,_=self.crm.gl_crm(*self.crm.M(Te,ne,Te,ne,E,write=False,copy=False),Sext=Sext) # Store to matrix
+        U=self.crm.Sgl(Te,ne,Te,ne,E,rad,Tm,write=False,Ton=Ton,copy=False) # Don't include erl1/erl2 radiation in the rates as these are handled by UEDGE
+        # Include T-losses or not?
+        retE=stack([sum(U[i][0],axis=-2) for i in range(5)],axis=-2)
+        extE=stack([sum(U[i][1],axis=-1) for i in range(5)],axis=-1)
         
 
         # Ensure output directory exists 
@@ -965,7 +928,7 @@ class CRUMPET:
         
         '''
         from matplotlib.pyplot import figure
-        from numpy import log10,sum
+        from numpy import log10,sum,linspace
         from os import mkdir
         
         # Get axis handle or create figure
@@ -979,12 +942,14 @@ class CRUMPET:
         if n0 is None:
             n0=self.crm.n0
 
+        tt=linspace(0,t,800) # Times at which to evaluate the solution
+
         # Check what model to use, Greenland or full
         if gl is True: # Greenland
-            nt=self.n_gl(Te,ne,t,Ti,ni,E,n0,Sext) # Solve ODE
+            nt=self.n_gl(Te,ne,tt,Ti,ni,E,n0,Sext) # Propagate densities
             Np,Nq,N=True,False,False # Np only option
         else: # Full model
-            nt=self.n_full(Te,ne,t,Ti,ni,E,n0,Sext) # Solve ODE
+            nt=self.n_full(Te,ne,tt,Ti,ni,E,n0,Sext) # Propagate densities
 
         if color is None: # Define color sequence up to 10 unless specific sequence requested
             color=[ 'b', 'r', 'm', 'c', 'darkgreen', 'gold', 'brown' ,'lime', 'grey', 'orange' ]
@@ -1126,16 +1091,16 @@ class CRUMPET:
 
         if isinstance(Te,list):
             x=Te
-            y=array([reactions[datalist[idx]].rate(T,None,ne=ne) for T in Te])/(ne**(idx>3))
+            y=reactions[datalist[idx]].rate(array(Te),None,ne=ne)/(ne**(idx>3))
             xlabel=(r'Electron temperature [eV]')
             ex=int(log10(ne))
             mu=ne/(10**ex) 
             autotitle=pretitle+r' {}, $\rm{{n_e}}$={}$\times10^{{{}}}$ $\rm{{cm^{{-3}}}}$'.format(typ,mu,ex)
         elif isinstance(ne,list): 
             x=ne
-            y=array([reactions[datalist[idx]].rate(Te,None,ne=n) for n in ne])
+            y=reactions[datalist[idx]].rate(Te,None,ne=array(ne))
             if idx>3:
-                y=y/ne
+                y=y/array(ne)
             xlabel=(r'Electron density [$\rm{cm^{-3}}$]')
             autotitle=pretitle+r' {}, $\rm{{T_e}}$={} [eV]'.format(typ,Te)
         else:
@@ -1273,7 +1238,7 @@ class CRUMPET:
                 # Setup plot type
                 if isinstance(Te,list):
                     x=Te
-                    y=array([reactions['H2_depl'].rate(T,None,ne=ne)*fac for T in Te])
+                    y=reactions['H2_depl'].rate(array(Te),None,ne=ne)*fac
                     xlabel=(r'Electron temperature [eV]')
                     ex=int(log10(ne))
                     mu=ne/(10**ex) 
@@ -1281,9 +1246,9 @@ class CRUMPET:
                     suptitle=pretitle+r'$\rm{{n_e}}$={}$\times10^{{{}}}$ $\rm{{cm^{{-3}}}}$'.format(mu,ex)
                 elif isinstance(ne,list): 
                     x=ne
-                    y=array([reactions['H2_depl'].rate(Te,None,ne=n)*fac for n in ne])
+                    y=reactions['H2_depl'].rate(Te,None,ne=array(ne))*fac
                     if idx>3:
-                        y=y/ne
+                        y=y/array(ne)
                     xlabel=(r'Electron density [$\rm{cm^{-3}}$]')
                     autotitle=title[i]
                     supttitle=pretitle+r' {}, $\rm{{T_e}}$={} [eV]'.format(typ,Te)
@@ -1314,7 +1279,7 @@ class CRUMPET:
                     # Setup plot type
                     if isinstance(Te,list):
                         x=Te
-                        y=array([reactions[datalist[i*3+j]].rate(T,None,ne=ne)*ev for T in Te])/(ne**(j==2))
+                        y=reactions[datalist[i*3+j]].rate(array(Te),None,ne=ne)*ev/(ne**(j==2))
                         xlabel=(r'Electron temperature [eV]')
                         ex=int(log10(ne))
                         mu=ne/(10**ex) 
@@ -1322,9 +1287,9 @@ class CRUMPET:
                         suptitle=pretitle+r'$\rm{{n_e}}$={}$\times10^{{{}}}$ $\rm{{cm^{{-3}}}}$'.format(mu,ex)
                     elif isinstance(ne,list): 
                         x=ne
-                        y=array([reactions[datalist[i*3+j]].rate(Te,None,ne=n)*ev for n in ne])
+                        y=reactions[datalist[i*3+j]].rate(Te,None,ne=array(ne))*ev
                         if j==2:
-                            y=y/ne
+                            y=y/array(ne)
                         xlabel=(r'Electron density [$\rm{cm^{-3}}$]')
                         autotitle=title[i]
                         supttitle=pretitle+r' {}, $\rm{{T_e}}$={} [eV]'.format(typ,Te)
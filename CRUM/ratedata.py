@@ -3,10 +3,19 @@
 # Changelog:
 #   200127 - Rewrote read_EIRENE into a class
 
+# Version of the rate data parsers: bump whenever the parsed output changes to invalidate binary caches
+PARSER_VERSION=4
+
+import re
+# Expressions for parsing the EIRENE tex files
+EIRENE_BEGIN=b'##BEGIN DATA HERE##'   # Marker of the start of the rate data
+EIRENE_HEAD=re.compile(rb' *(Reaction|b0|0|a0|h0|p0|k0)(?= |\r?\n|$) *([^ \r\n]*)')  # Line heads
+EIRENE_TROW=re.compile(rb' *([0-8]) +([^ \r\n]+ +[^ \r\n]+ +[^ \r\n]+)')   # T-index rows of (T,E)-fits
+EIRENE_STOP=[b'a0',b'h0',b'p0',b'k0']  # Non-coefficient rate entries
 
 
 class RATE_DATA:
-    def __init__(self,amjuel='amjuel.tex',hydhel='hydhel.tex',h2vibr='h2vibr.tex',ADAS='ich0-1.dat',UE='ehr1.dat',path='.'):
+    def __init__(self,amjuel='amjuel.tex',hydhel='hydhel.tex',h2vibr='h2vibr.tex',ADAS='ich0-1.dat',UE='ehr1.dat',path='.',cache=True):
         ''' Sets up an atomic and molecular reaction rate database
             __init__(*keys)
             
@@ -17,101 +26,255 @@ class RATE_DATA:
             ADAS ('ich0-1.dat')     -   Path to ADAS reaction rates data relative to the CWD, ADAS-04 format
             UE ('ehr1.dat')         -   Path to UEDGE rates relative to CWD, UEDGE loglog Te,ne fits
             path ('.')              -   Path if different from CWD
+            cache (True)            -   Store the parsed databases as binary npz files next to the 
+                                        source files and read them from there on subsequent loads
+
+            The databases are only opened once a reaction is requested from them through get_coeff.
+            For the EIRENE databases, an index of the coefficient block locations in the files is 
+            created, and only the requested coefficient blocks are parsed.
              
         '''
+        self.cache=cache
+        self.path=path
+        self.ADAS=ADAS
+        self.UE=UE
+        self.index={}   # Byte offsets of the EIRENE coefficient blocks
+        self.loaded=[]  # Databases opened so far
 
 
-        # Create a loop that reads the EIRENE tex files, compatible with Jan 2020 versions
-        self.reactions= {   'AMJUEL': {'settings' : [500, ['b0','0','a0','h0','p0','k0'], ['a0','h0','p0','k0'], 45], 'path' : amjuel },
-                            'HYDHEL': {'settings' : [150, ['b0','0','a0','h0'], ['a0','h0'], 80], 'path' : hydhel },
-                            'H2VIBR': {'settings' : [0, ['b0','0','a0','h0'], ['a0','h0'], 20], 'path' : h2vibr },
+        # Setup the databases, the EIRENE tex files are read from their BEGIN DATA marker
+        self.reactions= {   'AMJUEL': {'path' : amjuel },
+                            'HYDHEL': {'path' : hydhel },
+                            'H2VIBR': {'path' : h2vibr },
                             'UE': {},
                             'ADAS': {},
                         }
-        # For each data point, add the reactions to the appropriate dictionary
-        for rate in ['AMJUEL','H2VIBR','HYDHEL']:
-            self.read_EIRENE(self.reactions[rate]['path'],self.reactions[rate],self.reactions[rate]['settings'],path=path)
-        self.read_ADAS(ADAS,self.reactions['ADAS'])
-        self.read_UE(UE,self.reactions['UE'])
+
+
+    def load(self,database):
+        ''' Opens database: reads the data of ADAS and UE databases and indexes the EIRENE databases
+            load(database)
+
+            database    -   Database to open (string)
+        '''
+        if database in ['AMJUEL','H2VIBR','HYDHEL']:
+            self.index[database]={}
+            self.read_cached(self.index_EIRENE,self.reactions[database]['path'],self.index[database],path=self.path)
+        elif database=='ADAS':
+            self.read_cached(self.read_ADAS,self.ADAS,self.reactions['ADAS'])
+            # Rows of the excitation transitions in the upsilon array
+            self.index[database]={str(t):i for i,t in enumerate(self.reactions['ADAS']['transitions'])}
+        elif database=='UE':
+            self.read_cached(self.read_UE,self.UE,self.reactions['UE'])
+        self.loaded.append(database)
+
+
+
+    def read_cached(self,reader,fname,reactions,*args,path='.'):
+        ''' Reads the rate data file fname with reader, using a binary cache stored next to fname
+            read_cached(reader,fname,reactions,*args,*keys)
+
+            reader      -   Function reading the data, called as reader(fname,reactions,*args,path=path)
+            fname       -   File name to open from path
+            reactions   -   Dictionary where to store the read reaction rate coefficients
+            args        -   Additional arguments passed on to reader
+
+            Optional parameters
+            path ('.')  -   Path if different from CWD
+
+            The cache is written to path/fname.npz and holds the reaction IDs and stacked
+            coefficient arrays, grouped by coefficient shape and type. It is keyed by the SHA1 hash of
+            the file content, the parser version and the reader arguments, and is rebuilt
+            automatically whenever the key does not match. Failure to write the cache (e.g. on
+            read-only file systems) is ignored.
+        '''
+        from hashlib import sha1
+        from numpy import load,savez,array,stack
+        from os import replace,getpid,remove
+
+        if self.cache is False: # Parse directly if cache is turned off
+            reader(fname,reactions,*args,path=path)
+            return
+
+        src='{}/{}'.format(path,fname)
+        cachefile=src+'.npz'
+        # Create a key from the file content, parser version and the reader settings
+        with open(src,'rb') as f:
+            key=sha1(f.read())
+        key.update('{}{}{}'.format(PARSER_VERSION,reader.__name__,args).encode())
+        key=key.hexdigest()
+
+        # Try reading the cache, verifying that it is up to date
+        try:
+            with load(cachefile,allow_pickle=False) as data:
+                if str(data['key'])==key:
+                    for i in range(int(data['ngroups'])):
+                        ids,values=data['ids{}'.format(i)],data['values{}'.format(i)]
+                        for j in range(len(ids)):
+                            reactions[str(ids[j])]=values[j]
+                    return
+        except (OSError,KeyError,ValueError):
+            pass
+
+        # Parse the source file and group the coefficients by shape for stacking
+        parsed={}
+        reader(fname,parsed,*args,path=path)
+        reactions.update(parsed)
+        groups={}
+        for r,v in parsed.items():
+            v=array(v)
+            groups.setdefault((v.shape,v.dtype.kind),[[],[]])
+            groups[(v.shape,v.dtype.kind)][0].append(r)
+            groups[(v.shape,v.dtype.kind)][1].append(v)
+        out={'key':array(key),'ngroups':array(len(groups))}
+        for i,(ids,values) in enumerate(groups.values()):
+            out['ids{}'.format(i)]=array(ids)
+            out['values{}'.format(i)]=stack(values)
+
+        # Write to a temporary file and move in place, so that parallel readers never see partial caches
+        tmp='{}.{}.tmp'.format(cachefile,getpid())
+        try:
+            with open(tmp,'wb') as f:
+                savez(f,**out)
+            replace(tmp,cachefile)
+        except OSError:
+            try:
+                remove(tmp)
+            except OSError:
+                pass
 
 
 
 
-    def read_EIRENE(self,fname,reactions,settings,path='.'):
-        ''' Reads the LaTeX version of the EIRENE input data file and stores cofficients to reactions
-            read_EIRENE(fname,reactions,settings,*keys)
+    def index_EIRENE(self,fname,index,path='.'):
+        ''' Indexes the LaTeX version of the EIRENE input data file, storing the location of each reaction
+            index_EIRENE(fname,index,*keys)
     
             fname       -   File name to open from path 
-            reactions   -   Dictionary where to store the read reaction rate coefficients
-            settings    -   List of settings for reading the rate data
-                            settings[0] - Lines to omit from start of file
-                            settings[1] - Non-coefficient rate entries 
-                            settings[2] - Data rate entry
-                            settings[3] - Lines to omit from end of file
+            index       -   Dictionary where to store the byte offset of the coefficient block of each reaction
             
             Optional parameters
             path ('.')  -   Path if different from CWD
         '''
-        from numpy import zeros
-        from csv import reader
-        # Script parsing Hydhel.tex
-        lst,book=[],[]
-        # Open reader object
-        rd=reader(open('{}/{}'.format(path,fname),'rt'),delimiter=' ')
-        # Store book in list
-        for row in rd:
-            lst.append(row)
-        # Strip all empty arrays
-        lst=list(filter(None,lst))
-
-        for row in lst:
-            book.append(list(filter(None,row)))
-
-        i=settings[0] # Read from top
-        while True:
-            # Loop through rows looking for reactions
-            if book[i][0]=="Reaction":
-                reaction=book[i][1] # Store reaction name
-                i+=1
-                # Loop through reaction looking for coeffs
-                while True:
-                    if book[i][0] not in settings[1]:
-                        i+=1
-                     #   break
-                    # Break if wrong fits
-                    elif book[i][0] in settings[2]:
-                        break
-                    # We are in a T-fit
-                    elif book[i][0]=='b0':
-                        coeff=[]
-                        # Parse the next three lines
-                        for j in range(3):
-                            for k in range(3):
-                                coeff.append(float(book[i+j][1+k*2].replace(',','').replace('D','E')))
-                        i+=1
-                        reactions[reaction]=coeff
-                        break
-                    # Wea re in a (T,E)-fit
-                    elif book[i][0]=='0':
-                        coeff=zeros((9,9))
-                        # Parse the whole data block in one
-                        for j in range(3):
-                            for k in range(9):
-                                for l in range(3):
-                                    coeff[k,j*3+l]=float(book[i+k+j*9+j*2][l+1].replace('D','E'))
-                        # Store the coefficients
-                        # TODO: figure out better way to kill off ne,T fits??
-                        if reaction not in ['2.2.14','2.0l2']:
-                            reactions[reaction]=coeff
-                        
-                        i+=9+3*3+2*2 # Set counter after block
-                        break
-                    if i>=len(book)-settings[3]: # Omit last lines 
-                        break
-
-            i+=1
-            if i>=len(book)-settings[3]: # Omit last lines
-                break
+        fits,_,_=self.scan_EIRENE(fname,path=path,parse=False)
+        for reaction,[offset,fit,row] in fits.items():
+            index[reaction]=offset
+
+
+    def read_EIRENE_block(self,fname,offset,path='.'):
+        ''' Reads the coefficient block starting at offset in the LaTeX version of the EIRENE input data file
+            read_EIRENE_block(fname,offset,*keys)
+
+            fname       -   File name to open from path 
+            offset      -   Byte offset of the first line of the block, as stored by index_EIRENE
+
+            Optional parameters
+            path ('.')  -   Path if different from CWD
+
+            Returns
+            Array of the 9 coefficients for T-fits, or a 9x9 array of coefficients for (T,E)-fits
+        '''
+        fits,T,TE=self.scan_EIRENE(fname,path=path,offset=offset)
+        [[_,fit,row]]=fits.values()
+        return T[row] if fit=='T' else TE[row]
+
+
+    def scan_EIRENE(self,fname,path='.',offset=None,parse=True):
+        ''' Reads the LaTeX version of the EIRENE input data file in a single streaming pass
+            scan_EIRENE(fname,*keys)
+
+            fname       -   File name to open from path 
+
+            Optional parameters
+            path ('.')      -   Path if different from CWD
+            offset (None)   -   Byte offset of a single coefficient block to read. If None, the
+                                whole data section, following the BEGIN DATA marker, is read
+            parse (True)    -   Switch whether to parse the coefficients or only locate the blocks
+
+            Returns
+            fits,T,TE
+            fits    -   Dictionary of [offset, fit type ('T' or 'TE'), row in T or TE] for each reaction
+            T       -   Array (n,9) of the coefficients of the T-fits
+            TE      -   Array (n,9,9) of the coefficients of the (T,E)-fits
+
+            The lines are matched against the compiled expressions EIRENE_HEAD and EIRENE_TROW: a 
+            'Reaction' line opens a reaction, which is closed by its first b0 (T-fit), 0 ((T,E)-fit), 
+            or a0/h0/p0/k0 (unused fit) line. Later blocks overwrite earlier ones of the same reaction.
+        '''
+        from numpy import empty,concatenate
+        T,TE=empty((64,9)),empty((64,9,9))  # Preallocated coefficient arrays, doubled when full
+        nT,nTE=0,0
+        fits={}
+        reaction=None   # Reaction being read
+        rows=None       # Remaining lines of the T-fit or (T,E)-fit being read
+        with open('{}/{}'.format(path,fname),'rb') as f:
+            if offset is None:
+                for l in f: # Fast-forward to the data
+                    if EIRENE_BEGIN in l: break
+                pos=f.tell()
+            else:
+                f.seek(offset)
+                pos=offset
+                reaction=''
+            for l in f:
+                start=pos
+                pos+=len(l)
+                # Inside a T-fit: columns 1, 3 and 5 of the two following non-empty lines
+                if rows=='T':
+                    line=l.rstrip(b'\r\n')
+                    if len(line)==0: continue
+                    coeff+=line.split()[1:6:2]
+                    if len(coeff)<9: continue
+                    T[nT]=[float(x.replace(b',',b'').replace(b'D',b'E')) for x in coeff]
+                    nT+=1
+                    rows=None
+                    if offset is not None: break
+                    continue
+                # Inside a (T,E)-fit: three consecutive sets of 9 T-index rows, separated by headers
+                if rows=='TE':
+                    m=EIRENE_TROW.match(l)
+                    if m is None: continue
+                    k=int(m[1])
+                    TE[nTE,k,3*j:3*j+3]=[float(x) for x in m[2].replace(b'D',b'E').split()]
+                    if k==8: j+=1
+                    if j<3: continue
+                    nTE+=1
+                    rows=None
+                    if offset is not None: break
+                    continue
+                m=EIRENE_HEAD.match(l)
+                if m is None:
+                    continue
+                key=m[1]
+                if reaction is None:
+                    if key==b'Reaction':
+                        reaction=m[2].decode('latin-1')
+                    continue
+                if key in EIRENE_STOP: # Non-coefficient rate entries
+                    reaction=None
+                elif key==b'b0': # We are in a T-fit
+                    if nT==len(T): T=concatenate((T,empty(T.shape)))
+                    fits[reaction]=[start,'T',nT]
+                    if parse:
+                        coeff=l.split()[1:6:2]
+                        rows='T'
+                    else:
+                        nT+=1
+                    reaction=None
+                elif key==b'0': # We are in a (T,E)-fit
+                    # TODO: figure out better way to kill off ne,T fits??
+                    if reaction not in ['2.2.14','2.0l2']:
+                        if nTE==len(TE): TE=concatenate((TE,empty(TE.shape)))
+                        fits[reaction]=[start,'TE',nTE]
+                        if parse:
+                            m=EIRENE_TROW.match(l)
+                            TE[nTE,0,:3]=[float(x) for x in m[2].replace(b'D',b'E').split()]
+                            j=0
+                            rows='TE'
+                        else:
+                            nTE+=1
+                    reaction=None
+        return fits,T[:nT],TE[:nTE]
 
 
     def read_ADAS(self,fname,reactions,path='.'):
@@ -123,7 +286,11 @@ class RATE_DATA:
             
             Optional parameters
             path ('.')  -   Path if different from CWD
+
+            The effective collision strengths of the excitation transitions are stored as one array
+            reactions['upsilon'] (n_transitions, n_T), with the transition IDs in reactions['transitions']
         '''
+        from numpy import array
         # Constants turning the values into 
         cm1=1/8065.6
         kB=8.621738e-5
@@ -141,6 +308,7 @@ class RATE_DATA:
             # Read first rate line
             l=f.readline()
             # Read all unspecified data
+            transitions,upsilon=[],[]
             while l[0]==' ':
                 if l.strip()=='-1': break
                 [ul,ll]=l[:8].split()
@@ -148,8 +316,11 @@ class RATE_DATA:
                 l=[l[i:i+8].strip() for i in range(0,len(l),8)][:-1]
                 # Store excitation and relaxation data
                 reactions[ul+'-'+ll]=float(l[0][:-3]+'e'+l[0][-3:])
-                reactions[ll+'-'+ul]=[float(x[:-3]+'e'+x[-3:]) for x in l[1:len(reactions['T'])+1]]
+                transitions.append(ll+'-'+ul)
+                upsilon.append([float(x[:-3]+'e'+x[-3:]) for x in l[1:len(reactions['T'])+1]])
                 l=f.readline()
+            reactions['transitions']=array(transitions)
+            reactions['upsilon']=array(upsilon)
 
 
     def read_UE(self,fname,reactions,path='.',datalist=['IONIZ','REC','IONIZRAD','RECRAD']):
@@ -192,7 +363,18 @@ class RATE_DATA:
             
             database    -   Database in which to look for reaction (string)
             reaction    -   Reaction ID to retrieve from database (string)
+
+            Opens the database on first access. Coefficients of EIRENE reactions are 
+            parsed from their location in the database file on first request. ADAS
+            excitation transitions return their row of the upsilon array.
         '''
+        if database not in self.loaded:
+            self.load(database)
+        if database=='ADAS':
+            if reaction in self.index[database]:
+                return self.reactions[database]['upsilon'][self.index[database][reaction]]
+        elif (database in self.index) and (reaction not in self.reactions[database]):
+            self.reactions[database][reaction]=self.read_EIRENE_block(self.reactions[database]['path'],self.index[database][reaction],path=self.path)
 
         return(self.reactions[database][reaction])
 
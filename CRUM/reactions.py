@@ -4,7 +4,493 @@
 # 200205 - Separated from CRUM.py #holm10
 # 200210 - Updated ADAS extrapolation, tidied up code #holm10
  
+def same_state(state,new):
+    ''' Returns True if the stored plasma state equals new, comparing arrays elementwise
+        same_state(state,new)
+
+        state       -   Tuple of the stored plasma parameters, or None
+        new         -   Tuple of the plasma parameters to compare to
+    '''
+    from numpy import ndim,array_equal
+    if state is None:
+        return False
+    for old,x in zip(state,new):
+        if ndim(old)==0 and ndim(x)==0:
+            if old is not x and old!=x: return False
+        elif not array_equal(old,x):
+            return False
+    return True
+
+
+def copy_state(state):
+    ''' Returns a copy of the plasma state tuple state, unaffected by in-place changes of its arrays '''
+    from numpy import ndim,array
+    return tuple(array(x) if ndim(x)>0 else x for x in state)
+
+
+def state_key(state):
+    ''' Returns a hashable key of the plasma state tuple state, arrays are keyed by their contents '''
+    from numpy import asarray
+    return tuple(   (type(x).__name__,x) if not hasattr(x,'shape') else 
+                    (asarray(x).shape,asarray(x).dtype.str,asarray(x).tobytes()) for x in state)
+
+
+
+class ADAS_STACK:
+
+
+    def __init__(self,Tarr,upsilon):
+        ''' Creates a stack of ADAS excitation rates sharing the same temperature points
+            __init__(Tarr,upsilon)
+
+            Tarr        -   Temperature points of the ADAS data [eV]
+            upsilon     -   Effective collision strengths of the transitions, array (n_transitions,n_T)
+
+            All transitions in the stack are evaluated in one vectorized interpolation call.
+            The rates at the latest temperature are kept, so that consecutive requests of the 
+            transitions in the stack at the same temperature are not re-evaluated.
+        '''
+        from numpy import array
+        self.Tarr=array(Tarr)
+        self.upsilon=array(upsilon,ndmin=2)
+        self.T=None     # Temperature of the latest evaluation
+        self.rates=None # Rates of the latest evaluation
+
+
+    def rate(self,T):
+        ''' Returns the ADAS rates of all transitions in the stack at the specified temperature
+            rate(T)
+
+            T           -   Electron temperature for evaluation [eV]
+
+            Returns an array (n_transitions,)+shape(T) of rates, linearly interpolated in T and 
+            bounded to the temperature points of the data
+        '''
+        from numpy import sqrt,clip,searchsorted
+
+        if same_state(self.T,(T,)):
+            return self.rates
+        # TODO: How to deal with extrapolation?
+        Tuse=clip(T,self.Tarr[0],self.Tarr[-1])
+        i=clip(searchsorted(self.Tarr,Tuse),1,len(self.Tarr)-1)   # Upper bounding temperature point
+        w=(Tuse-self.Tarr[i-1])/(self.Tarr[i]-self.Tarr[i-1])      # Linear interpolation weight
+        # Return the rate as calculated from the ADAS fit, per the ADAS manual
+        self.rates=2.1716e-8*sqrt(13.6048/Tuse)*(self.upsilon[:,i-1]*(1-w)+self.upsilon[:,i]*w)
+        self.T=copy_state((T,))
+        return self.rates
+
+
+
+class REACTION_TABLE:
+
+
+    def __init__(self,reactions):
+        ''' Creates a struct-of-arrays table of the rate data of reactions
+            __init__(reactions)
+
+            reactions   -   List of REACTION objects to collect into the table
+
+            The coefficients of the EIRENE T-fits are stored as one array (R,9), those of the
+            (T,E)-fits as one array (R,9,9), the UEDGE tables as one array (R,nT,nn), and the 
+            ADAS reactions are collected into one ADAS_STACK. Each tabulated reaction is pointed
+            to its row of the table through its table and row attributes. All rates of a kind 
+            are evaluated together, e.g. the EIRENE fits from one power basis and one matrix 
+            product, and are kept for the latest plasma state. 
+
+            The EIRENE, ADAS and SIGMA rates can additionally be pretabulated, see tabulate.
+        '''
+        from numpy import array,zeros
+
+        def column(r):  # Temperature used by the reaction: Te, Ti or none
+            if 'e' in r.reactants:      return 0
+            elif 'p' in r.reactants:    return 1
+            else:                       return 2
+
+        fit1=[r for r in reactions if r.type=='RATE' and len(r.coeffs.shape)==1]
+        fit2=[r for r in reactions if r.type=='RATE' and len(r.coeffs.shape)==2]
+        adas=[r for r in reactions if r.type=='ADAS']
+        ue=[r for r in reactions if r.type=='UE']
+        sigma=[r for r in reactions if r.type=='SIGMA']
+        self.reactions=fit1+fit2+adas+sigma # Reactions which can be pretabulated
+        # Coefficient arrays and the temperature columns of each row
+        self.coeffs1=array([r.coeffs for r in fit1]).reshape((len(fit1),9))
+        self.coeffs2=array([r.coeffs for r in fit2]).reshape((len(fit2),81))
+        self.col1=array([column(r) for r in fit1],dtype=int)
+        self.col2=array([column(r) for r in fit2],dtype=int)
+        self.ue=array([r.coeffs for r in ue])
+        self.adas=None
+        if len(adas)>0:
+            self.adas=ADAS_STACK(adas[0].Tarr,[r.coeffs for r in adas])
+        # Point the reactions to their rows
+        for rows in [fit1,fit2,adas,ue,sigma]:
+            for i in range(len(rows)):
+                rows[i].table=self
+                rows[i].row=i
+                rows[i].tab=None
+        self.state1=None    # Plasma state of the latest T-fit evaluation
+        self.state2=None    # Plasma state of the latest (T,E)-fit evaluation
+        self.stateue=None   # Plasma state of the latest UEDGE evaluation
+        self.rates1=zeros((len(fit1),))
+        self.rates2=zeros((len(fit2),))
+        self.ratesue=zeros((len(ue),))
+        self.tabT=None      # Pretabulation grids and logarithmic rates
+        self.tabT2=None
+        self.tabE=None
+        self.tab1=None
+        self.tab2=None
+        self.statetab1=None # Plasma states of the latest table lookups
+        self.statetab2=None
+
+
+    def basis(self,Te,Ti,E=None):
+        ''' Returns the power basis of the EIRENE fits and the low-temperature multipliers
+            basis(Te,Ti,*keys)
+
+            Te          -   Electron temperature [eV]
+            Ti          -   Ion temperature [eV]
+
+            Optional parameters
+            E (None)    -   Target particle energy [eV]: the basis of (T,E)-fits is returned if given
+
+            Returns
+            P,coeff
+            P       -   Array (3,...,9) of the powers of ln(T) for T=Te, Ti, and 0, or array (3,...,81)
+                        of the flattened powers ln(T)**i*ln(E)**j if E is given
+            coeff   -   Array (3,...) of multipliers extrapolating the rates linearly to zero below 0.5 eV
+        '''
+        from numpy import array,log,maximum,broadcast_arrays,ones
+
+        def powers(x): # Powers 0..8 of x along a new last axis, by repeated multiplication
+            P=ones(x.shape+(9,))
+            for i in range(1,9):
+                P[...,i]=P[...,i-1]*x
+            return P
+
+        T=broadcast_arrays(Te,0 if Ti is None else Ti,0,1 if E is None else E)
+        Tuse=maximum(array(T[:3],dtype=float),0.5)
+        P=powers(log(Tuse))
+        if E is not None:
+            P=(P[...,:,None]*powers(log(T[3]))[None,...,None,:]).reshape(P.shape[:-1]+(81,))
+        T=array(T[:3],dtype=float)
+        return P,T/Tuse
+
+
+    def rate1(self,Te,Ti):
+        ''' Returns the rates of all EIRENE T-fits in the table
+            rate1(Te,Ti)
+
+            Te          -   Electron temperature for evaluation, used if electron reaction [eV]
+            Ti          -   Ion temperature for evaluation, used if proton impact [eV]
+
+            Returns an array (R,)+shape of the rates, where shape is the broadcast shape of Te and Ti
+        '''
+        from numpy import exp,arange
+        if not same_state(self.state1,(Te,Ti)):
+            P,coeff=self.basis(Te,Ti)
+            self.rates1=(coeff[...,None]*exp(P@self.coeffs1.T))[self.col1,...,arange(len(self.col1))]
+            self.state1=copy_state((Te,Ti))
+        return self.rates1
+
+
+    def rate2(self,Te,Ti,E):
+        ''' Returns the rates of all EIRENE (T,E)-fits in the table
+            rate2(Te,Ti,E)
+
+            Te          -   Electron temperature for evaluation, used if electron reaction [eV]
+            Ti          -   Ion temperature for evaluation, used if proton impact [eV]
+            E           -   Target particle energy [eV]
+
+            Returns an array (R,)+shape of the rates, where shape is the broadcast shape of Te, Ti and E
+        '''
+        from numpy import exp,arange
+        if not same_state(self.state2,(Te,Ti,E)):
+            P,coeff=self.basis(Te,Ti,E)
+            self.rates2=(coeff[...,None]*exp(P@self.coeffs2.T))[self.col2,...,arange(len(self.col2))]
+            self.state2=copy_state((Te,Ti,E))
+        return self.rates2
+
+
+
+    def rateue(self,Te,ne):
+        ''' Returns the rates of all UEDGE tables in the table
+            rateue(Te,ne)
+
+            Te          -   Electron temperature for evaluation [eV]
+            ne          -   Electron density for evaluation [cm**-3]
+
+            Returns an array (R,)+shape of the rates, where shape is the broadcast shape of Te and ne.
+            The tables are interpolated bilinearly in the log-log indices jt=10*(log10(Te)+1.2) and
+            jn=2*(log10(ne)-10), bounded to the table limits. The indices and weights are computed
+            once per plasma state and shared by all tables.
+        '''
+        from numpy import log10,clip,floor
+        if not same_state(self.stateue,(Te,ne)):
+            nt,nn=self.ue.shape[1:]
+            # Turn the temperature and density into log-log variables, bounded to the limits
+            jt=clip(10*(log10(Te+1e-99)+1.2),0,nt-1)
+            jn=clip(2*(log10(ne)-10),0,nn-1)
+            it=clip(floor(jt),0,nt-2).astype(int)   # Lower bounding table indices
+            iN=clip(floor(jn),0,nn-2).astype(int)
+            wt=jt-it    # Bilinear interpolation weights
+            wn=jn-iN
+            self.ratesue=   (1-wt)*(1-wn)*self.ue[:,it,iN]+wt*(1-wn)*self.ue[:,it+1,iN] \
+                            +(1-wt)*wn*self.ue[:,it,iN+1]+wt*wn*self.ue[:,it+1,iN+1]
+            self.stateue=copy_state((Te,ne))
+        return self.ratesue
+
+
+
+    def tabulate(self,rtol=1e-3,T=[0.1,1e4],E=[0.1,1e3],points=4,maxpoints=5000):
+        ''' Pretabulates the EIRENE, ADAS and SIGMA rate coefficients on adaptive log-log grids
+            tabulate(*keys)
+
+            Optional parameters
+            rtol (1e-3)         -   Maximum relative error of the tabulated rates
+            T ([0.1,1e4])       -   Temperature limits of the tables [eV]
+            E ([0.1,1e3])       -   Target particle energy limits of the (T,E)-fit tables [eV]
+            points (4)          -   Points per decade of the initial grids
+            maxpoints (5000)    -   Maximum number of points along each grid
+
+            The logarithms of the rates are tabulated on one grid in ln(T), shared by all
+            reactions, and the (T,E)-fits on one grid in ln(T) and ln(E). The initial grids 
+            include the ADAS temperature points and the 0.5 eV limit of the EIRENE fits, 
+            where the rates have kinks. Intervals are bisected until linear interpolation 
+            reproduces the rates at all interval midpoints to within rtol (rtol/2 along each 
+            axis of the (T,E)-grid). Afterwards, the rates of the tabulated reactions are 
+            interpolated from the tables, sharing the interpolation weights of each plasma 
+            state. Rates requested outside the tabulation limits are evaluated directly.
+        '''
+        from numpy import log,exp,linspace,concatenate,unique,argsort,array,maximum,abs,expm1,errstate,where,ones,zeros
+        lmin=log(1e-250)    # Rates below which the relative error is not controlled
+
+        # Only reactions depending on Te or Ti are tabulated
+        react=[r for r in self.reactions if ('e' in r.reactants) or ('p' in r.reactants)]
+        react1=[r for r in react if not (r.type=='RATE' and len(r.coeffs.shape)==2)]
+        react2=[r for r in react if r.type=='RATE' and len(r.coeffs.shape)==2]
+        for r in react: # Evaluate the rates directly while tabulating
+            r.tab=None
+
+        def logrates(reactions,T,E=None):
+            # Evaluate in chunks of T to bound the memory of the (T,E)-fit power bases
+            n=max(1,2**15//(1 if E is None else len(E.T)))
+            with errstate(divide='ignore',under='ignore'):
+                return concatenate([log(maximum([r.rate(T[i:i+n],T[i:i+n],E) for r in reactions],1e-300)) 
+                                    for i in range(0,len(T),n)],axis=1)
+
+        def grid(lim,extra=[]):
+            lim=log(lim)
+            x=linspace(lim[0],lim[1],max(int((lim[1]-lim[0])/log(10)*points),1)+1)
+            extra=log(array(extra,dtype=float))
+            return unique(concatenate((x,extra[(extra>lim[0])&(extra<lim[1])])))
+
+        def refine(x,y,f,tol,axis):
+            # Bisects the intervals along axis of the grid x, tabulated values y=f(x), to tolerance tol
+            y=y.swapaxes(1,axis)
+            pending=ones((len(x)-1,),dtype=bool)    # Intervals not yet checked
+            while pending.any() and len(x)<maxpoints:
+                i=pending.nonzero()[0]
+                xm=(x[i]+x[i+1])/2
+                ym=f(xm).swapaxes(1,axis)
+                yi=(y[:,i]+y[:,i+1])/2
+                # Relative error of the interpolation: negligible rates are not refined
+                with errstate(invalid='ignore'):
+                    err=where((ym<lmin)&(yi<lmin),0,abs(expm1(yi-ym)))
+                bad=err.reshape((len(y),len(xm),-1)).max(axis=(0,2))>tol
+                # Insert the midpoints of the bad intervals: only the new intervals are checked next
+                new=concatenate((zeros((len(x),),dtype=bool),ones((bad.sum(),),dtype=bool)))
+                order=argsort(concatenate((x,xm[bad])),kind='stable')
+                x=concatenate((x,xm[bad]))[order]
+                y=concatenate((y,ym[:,bad]),axis=1)[:,order]
+                new=new[order]
+                pending=new[1:]|new[:-1]
+            return x,y.swapaxes(1,axis)
+
+        Tgrid=grid(T,[0.5]+([] if self.adas is None else list(self.adas.Tarr)))
+        # Tabulate the rates depending on T only
+        self.tabT=Tgrid
+        self.tab1=None
+        if len(react1)>0:
+            f=lambda x: logrates(react1,exp(x))
+            self.tabT,self.tab1=refine(Tgrid,f(Tgrid),f,rtol,1)
+        # Tabulate the rates depending on T and E, refining each axis in turn
+        self.tab2=None
+        if len(react2)>0:
+            x,z=Tgrid,grid(E)
+            y=logrates(react2,exp(x)[:,None],exp(z)[None,:])
+            while True:
+                n=(len(x),len(z))
+                x,y=refine(x,y,lambda xm: logrates(react2,exp(xm)[:,None],exp(z)[None,:]),rtol/2,1)
+                z,y=refine(z,y,lambda zm: logrates(react2,exp(x)[:,None],exp(zm)[None,:]),rtol/2,2)
+                if n==(len(x),len(z)):
+                    break
+            self.tabT2,self.tabE,self.tab2=x,z,y
+        # Point the reactions to their rows in the tables
+        for rows in [react1,react2]:
+            for i in range(len(rows)):
+                rows[i].tab=i
+        self.statetab1=None
+        self.statetab2=None
+
+
+    def lookup(self,r,Te,Ti,E=None):
+        ''' Returns the pretabulated rate of reaction r, or None if outside the tabulation limits
+            lookup(r,Te,Ti,*keys)
+
+            r           -   Tabulated REACTION object
+            Te          -   Electron temperature for evaluation, used if electron reaction [eV]
+            Ti          -   Ion temperature for evaluation, used if proton impact [eV]
+
+            Optional parameters
+            E (None)    -   Target particle energy, used by (T,E)-fits [eV]
+        '''
+        from numpy import log,exp,searchsorted,clip,asarray,errstate,all
+
+        def weights(grid,x): # Bounding indices and linear interpolation weights in ln(x)
+            with errstate(divide='ignore',invalid='ignore'):
+                x=log(asarray(0 if x is None else x,dtype=float))
+            i=clip(searchsorted(grid,x)-1,0,len(grid)-2)
+            return i,(x-grid[i])/(grid[i+1]-grid[i]),all((x>=grid[0])&(x<=grid[-1]))
+
+        c=0 if 'e' in r.reactants else 1    # Te or Ti
+        if r.type=='RATE' and len(r.coeffs.shape)==2:
+            if not same_state(self.statetab2,(Te,Ti,E)):
+                j,v,Einside=weights(self.tabE,E)
+                self.tabrates2,self.inside2=[],[]
+                for T in [Te,Ti]:
+                    i,w,inside=weights(self.tabT2,T)
+                    y=self.tab2
+                    self.tabrates2.append(  (1-w)*(1-v)*y[:,i,j]+w*(1-v)*y[:,i+1,j]
+                                            +(1-w)*v*y[:,i,j+1]+w*v*y[:,i+1,j+1])
+                    self.inside2.append(inside and Einside)
+                self.statetab2=copy_state((Te,Ti,E))
+            if not self.inside2[c]:
+                return None
+            return exp(self.tabrates2[c][r.tab])
+        else:
+            if not same_state(self.statetab1,(Te,Ti)):
+                self.tabrates1,self.inside1=[],[]
+                for T in [Te,Ti]:
+                    i,w,inside=weights(self.tabT,T)
+                    self.tabrates1.append((1-w)*self.tab1[:,i]+w*self.tab1[:,i+1])
+                    self.inside1.append(inside)
+                self.statetab1=copy_state((Te,Ti))
+            if not self.inside1[c]:
+                return None
+            return exp(self.tabrates1[c][r.tab])
+
+
+
+ENERGY_NAMES=['Te','Ti','Ta','Tm']   # Temperatures allowed in energy expressions, Ta is an alias of Ti
+ENERGY_MARKERS=['erl1','erl2']      # Ionization and recombination radiation markers
+
+
+def fold_energy(node,keys):
+    ''' Returns a validated, constant-folded copy of the AST node of an energy expression
+        fold_energy(node,keys)
+
+        node        -   AST node of the energy expression
+        keys        -   Dictionary of energy handles, substituted as constants
+
+        Only numbers, the names in ENERGY_NAMES and ENERGY_MARKERS, the energy handles and the
+        operators +,-,*,/ and ** are accepted. Operations on constants are evaluated.
+    '''
+    import ast
+    from operator import add,sub,mul,truediv,pow,neg,pos
+    binops={ast.Add:add,ast.Sub:sub,ast.Mult:mul,ast.Div:truediv,ast.Pow:pow}
+    unops={ast.USub:neg,ast.UAdd:pos}
+
+    if isinstance(node,ast.Expression):
+        return ast.Expression(fold_energy(node.body,keys))
+    elif isinstance(node,ast.Constant) and type(node.value) in [int,float]:
+        return ast.Constant(node.value)
+    elif isinstance(node,ast.Name):
+        if node.id in keys:
+            return ast.Constant(keys[node.id])
+        elif node.id in ENERGY_NAMES+ENERGY_MARKERS:
+            return ast.Name(node.id,ast.Load())
+        raise ValueError('Unknown handle "{}" in energy expression'.format(node.id))
+    elif isinstance(node,ast.BinOp) and type(node.op) in binops:
+        left,right=fold_energy(node.left,keys),fold_energy(node.right,keys)
+        if isinstance(left,ast.Constant) and isinstance(right,ast.Constant):
+            return ast.Constant(binops[type(node.op)](left.value,right.value))
+        return ast.BinOp(left,node.op,right)
+    elif isinstance(node,ast.UnaryOp) and type(node.op) in unops:
+        operand=fold_energy(node.operand,keys)
+        if isinstance(operand,ast.Constant):
+            return ast.Constant(unops[type(node.op)](operand.value))
+        return ast.UnaryOp(node.op,operand)
+    raise ValueError('Unsupported expression "{}" in energy expression'.format(ast.unparse(node)))
+
+
+
+class ENERGY:
+    __slots__=['expr','code','value','erl','rad']
+
+
+    def __init__(self,expr,keys={}):
+        ''' Compiles an energy expression of a reaction into a callable of the temperatures
+            __init__(expr,*keys)
+
+            expr        -   Energy expression (string) in Te, Ti (or Ta) and Tm [eV]
+
+            Optional parameters
+            keys ({})   -   Dictionary of energy handles to substitute into the expression [eV]
+
+            The expression is validated and constant-folded on creation, see fold_energy.
+            The radiation markers erl1 and erl2 are removed from the expression and stored as 
+            flags: erl is 1 for ionization radiation, 2 for recombination radiation and 0 
+            otherwise, and rad is the coefficient of the marker in the expression.
+        '''
+        import ast
+        tree=ast.fix_missing_locations(fold_energy(ast.parse(expr.strip(),mode='eval'),keys))
+        self.expr=ast.unparse(tree)
+        self.code=compile(tree,'<energy>','eval')
+        self.value=tree.body.value if isinstance(tree.body,ast.Constant) else None
+        
+        markers=[i+1 for i in range(2) if ENERGY_MARKERS[i] in [n.id for n in ast.walk(tree) if isinstance(n,ast.Name)]]
+        if len(markers)>1:
+            raise ValueError('Only one radiation marker allowed in energy expression "{}"'.format(expr))
+        self.erl=markers[0] if markers else 0
+        self.rad=0
+        if self.erl:
+            self.rad=self.evaluate(0,0,0,1)-self.evaluate(0,0,0,0)
+
+
+    def __repr__(self):
+        return self.expr
+
+
+    def evaluate(self,Te,Ti,Tm,erl=0):
+        ''' Evaluates the expression with the radiation marker set to erl '''
+        return eval(self.code,{'__builtins__':{}},{'Te':Te,'Ti':Ti,'Ta':Ti,'Tm':Tm,'erl1':erl,'erl2':erl})
+
+
+    def __call__(self,Te,Ti,Tm):
+        ''' Returns the energy [eV] at the specified temperatures, excluding radiation
+            __call__(Te,Ti,Tm)
+
+            Te          -   Electron temperature [eV]
+            Ti          -   Ion temperature [eV]
+            Tm          -   Molecular temperature [eV]
+
+            The temperatures can be arrays, in which case an array of the broadcast shape is returned
+        '''
+        from numpy import broadcast,full
+        if self.value is not None:
+            shape=broadcast(Te,Ti,Tm).shape
+            return full(shape,float(self.value)) if shape else self.value
+        return self.evaluate(Te,Ti,Tm)
+
+
+
+# Number of Gauss-Legendre nodes used for the Maxwellian averaging of cross-sections
+SIGMA_NODES=64
+
+
+
 class REACTION:
+    __slots__=['name','database','reactants','fragments','coeffs','type','Tarr','S_r','S_g','S_V','S_e',
+                'r_mult','f_mult','nodes','table','row','tab']
 
 
     def __init__(self, name, database, reactants, fragments, coeffs,typ,S,Tarr=0):
@@ -29,11 +515,10 @@ class REACTION:
             
         '''
         from numpy import ones,array
-        from scipy.interpolate import interp2d,interp1d
+        from numpy.polynomial.legendre import leggauss
         
         # Store the data required to generate the reaction rates
         self.name=name
-        self.coeffs=coeffs
         self.database=database
         self.reactants=[r.strip() for r in reactants]
         self.fragments=[f.strip() for f in fragments]
@@ -41,7 +526,7 @@ class REACTION:
         self.type=typ
         self.Tarr=array(Tarr)
         for i in range(4):
-            if isinstance(S[i],str): S[i]=S[i][4:]
+            if isinstance(S[i],str): S[i]=ENERGY(S[i][4:])  # Compile expressions given as 'S_x=...'
 
         self.S_r=S[0]
         self.S_g=S[1]
@@ -65,15 +550,16 @@ class REACTION:
                 self.fragments[i]=fragments[i].split('*')[1].strip()    # Remove the multiplier from fragment string
 
 
-        ''' Make interpolation object if necessary '''
-        if self.type=='UE': # UEDGE interpolator
-            t=[i for i in range(self.coeffs.shape[0])]
-            n=[i for i in range(self.coeffs.shape[1])]
+        ''' Make interpolation and integration data if necessary '''
+        if self.type=='SIGMA': # Fixed-order quadrature nodes for the Maxwellian averaging
+            self.nodes=leggauss(SIGMA_NODES)
 
-            self.interpolation=interp2d(n,t,self.coeffs,kind='linear') # Create 2D interpolation function
-
-        if self.type=='ADAS': # ADAS interpolator
-            self.interpolation=interp1d(self.Tarr,self.coeffs,kind='slinear')   # Create 1D interpolation function
+        # Tabulate EIRENE, ADAS and UEDGE rates: replaced by a shared table when collected into a CRM
+        self.table=None
+        self.row=None
+        self.tab=None   # Row in the pretabulated rates, if tabulated
+        if self.type in ['RATE','ADAS','UE','SIGMA']:
+            REACTION_TABLE([self])
 
 
     
@@ -91,6 +577,44 @@ class REACTION:
         
         return ret 
 
+
+    def sigma(self,E):
+        ''' Returns the Sawada cross-section fit at energy E
+            sigma(E)
+
+            E           -   Impact energy [eV]
+        '''
+        Eth,q0,A,Omega,W,gamma,nu=self.coeffs[:7]
+        Psi=(nu!=0)*(1-W/E)**nu+(gamma!=0)*(1-(W/E)**gamma) # Get triplet/singlet Psi
+        return (E>=Eth)*q0*(A/W**2)*((W/Eth)**Omega)*Psi    # Perform fit
+
+
+    def maxwellian(self,T):
+        ''' Returns the Maxwellian average of the cross-section integral over velocity space 
+            maxwellian(T)
+
+            T           -   Temperature for evaluation [eV]
+
+            Evaluates the integral int_0^inf x*sigma(x*T)*exp(-x) dx, as described in JUEL-3858, 
+            vectorized over T. Below the threshold Eth the integrand vanishes: the integral is
+            taken over z=ln(x*T/Eth) from 0 to ln(1+40*T/Eth), truncating the tail at exp(-40), 
+            using Gauss-Legendre quadrature with SIGMA_NODES nodes. The integrand is smooth in z, 
+            so that the relative error is below 1e-9 for 0.1<T<1e5 eV, as long as the 
+            cross-section is continuous at the threshold (W<Eth). 
+        '''
+        from numpy import exp,log1p,where,asarray,errstate,sum
+        s,w=self.nodes
+        Eth=self.coeffs[0]
+        T=asarray(T,dtype=float)
+        Tuse=where(T>0,T,1)[...,None]
+        a=Eth/Tuse          # Threshold in units of T
+        zmax=log1p(40/a)    # Upper limit of the integral
+        x=a*exp((s+1)*zmax/2)
+        with errstate(under='ignore'):
+            # The Jacobian is dx=x*dz
+            ret=sum(w*zmax/2*x*x*self.sigma(x*Tuse)*exp(-x),axis=-1)
+        return where(T>0,ret,0)[()]
+
             
     def rate(self,Te,Ti,E=None,ne=None,omegaj=1):
         ''' Returns the reaction rate at the specified temperature
@@ -103,9 +627,11 @@ class REACTION:
             E (None)    -   Target particle energy, used if proton impact [eV]
             ne (None)   -   Electron density, used for UEDGE rates [cm**3]
             omegaj (1)  -   Statistical weight of ADAS rates 
+
+            Te, Ti, E and ne can be given as arrays: the rates are returned in their broadcast shape.
+            Pretabulated rates are interpolated from the tables of REACTION_TABLE.tabulate.
         '''
-        from numpy import log,exp,sqrt,pi,inf,array,log10
-        from scipy.integrate import quad
+        from numpy import sqrt,pi,broadcast,full
 
         # Find reactant species
         if 'e' in self.reactants:   T=Te # Electron-mediated reaction, use Te
@@ -117,89 +643,53 @@ class REACTION:
 
 
 
+        # Look up pretabulated rates
+        if self.tab is not None:
+            ret=self.table.lookup(self,Te,Ti,E)
+            if ret is not None:
+                return ret/(omegaj if self.type=='ADAS' else 1)
+
         # Get rate based on self.type
         if self.type=='RATE':
             ''' We have an EIRENE polynomial fit '''
-            ret=0
-            if T<0.5:   
-                Tuse=0.5
-                coeff=T/Tuse
-            else:       
-                Tuse=T
-                coeff=1
-
+            # All fits of the table are evaluated together, the rates are extrapolated linearly to zero below 0.5 eV
             if len(self.coeffs.shape)==2:
                 ''' T,E fit '''
-                for i in range(9):
-                    for j in range(9):
-                        ret+=self.coeffs[i,j]*(log(Tuse)**i)*(log(E)**j)
+                return self.table.rate2(Te,Ti,E)[self.row]
 
             elif len(self.coeffs.shape)==1: 
                 ''' T fit '''
-                for i in range(9):
-                    ret+=self.coeffs[i]*(log(Tuse)**i)
+                return self.table.rate1(Te,Ti)[self.row]
                     
             else:
                 print('Unknown fit')
 
-            return coeff*exp(ret)
-
         elif self.type=='COEFFICIENT':
             ''' Coefficient '''
-            return self.coeffs
+            shape=broadcast(*[x for x in [Te,Ti,E,ne] if x is not None]).shape
+            if len(shape)==0:
+                return self.coeffs
+            return full(shape,self.coeffs)
 
         elif self.type=='SIGMA':
             ''' SAWADA cross-section '''
             # TODO Extend to general species?
-            mH2=2*1.6735575e-27 # Assume H2 is reactant 1
             me=9.10938356e-31   # Assume electron is reactant 2
             ev=1.602e-19        # Helper
-            VH2=sqrt((2*E*ev)/mH2)  # Get the H2 velocity
-            Ve=sqrt((2*T*ev)/me)    # Get the e- velocity
-            mr=(me*mH2)/(me+mH2)    # Reduced mass
-            vth=sqrt((2*self.coeffs[0]*ev)/mr)  # Thermal CM speed
-            
-            def sigma(E,Eth,q0,A,Omega,W,gamma,nu): # Calculate sigma from the Sawada fit based on E
-                Psi=(nu!=0)*(1-W/E)**nu+(gamma!=0)*(1-(W/E)**gamma) # Get triplet/singlet Psi
-                return (E>=Eth)*q0*(A/W**2)*((W/Eth)**Omega)*Psi    # Perform fit
-            
-            def R(x,T,coeffs):
-                # Integrand function as described in JUEL-3858
-                return x*sigma(x*T,*self.coeffs)*exp(-x)
-
-            # Perform integration over velocity space according to JUEL-3858
-            return (4/sqrt(pi))*sqrt((T*ev)/(2*me))*quad(R,0,inf,args=(T,self.coeffs))[0]
+            return (4/sqrt(pi))*sqrt((T*ev)/(2*me))*self.maxwellian(T)
 
 
         elif self.type=='ADAS':
             ''' ADAS fit '''
-            if T<self.Tarr[0]:
-                Tuse=self.Tarr[0]
-                coeff=T/Tuse
-            else:
-                Tuse=T
-                coeff=1
-            Tuse=min(Tuse,self.Tarr[-1])
-#            T=max(T,self.Tarr[0])
-            # TODO: How to deal with extrapolation?
             # TODO: figure out what is implied by the statistical weight omegaj - set =1 for now
-            # Return the rate as calculated from the ADAS fit, per the ADAS manual
-            return 2.1716e-8*(1/omegaj)*sqrt(13.6048/Tuse)*self.interpolation(Tuse) 
+            return (1/omegaj)*self.table.adas.rate(T)[self.row]
         
         elif self.type=='UE':
             ''' UEDGE fit '''
-            # Turn the temperature and density into log-log variables, bounded to the limits
-            jt=max(0,min(10*(log10(Te+1e-99)+1.2),60))
-            jn=max(0,min(2*(log10(ne)-10),15))
-            # Interpolate jt
-            
             c=1
             if self.name in ['RECRAD','IONIZRAD']: c=6.242e11
-            return self.interpolation(jn,jt)[0]*c
+            return self.table.rateue(Te,ne)[self.row]*c
                     
         else:
             print('Unknown type "{}"'.format(self.type))
-    
-
-
 